@@ -1,3 +1,4 @@
+import pytest
 import wasmer
 
 from wasmtree import Builder, Buffer, parser
@@ -57,3 +58,169 @@ def test_simple_module():
 
     received = Buffer().write_module(module).getvalue()
     assert received == contents
+
+
+def test_data_segments_accept_buffer_objects():
+    builder = Builder()
+    contents = memoryview(bytearray(b'\x01\x02\x03\x04'))
+
+    builder.add_active_data_segment([parser.i32_const(0)], contents)
+    builder.add_passive_data_segment(bytearray(b'\x05\x06'))
+
+    # The buffer object is stored as-is, without being copied.
+    assert builder.data_segments[0].contents is contents
+
+    try:
+        builder.add_passive_data_segment('not bytes')
+        assert False, 'Expected a TypeError.'
+    except TypeError:
+        pass
+
+
+def test_expression_conversion():
+    builder = Builder()
+    received = builder.expression([
+        ('local.get', 0),
+        ('i32.load8_u', 0, 4),
+        'i32.eqz',
+        ('Block', 'empty', [('br_if', 0), 'nop']),
+    ])
+    assert received == [
+        parser.local_get(0),
+        parser.i32_load8_u(0, 4),
+        parser.i32_eqz(),
+        parser.Block('empty', [parser.br_if(0), parser.nop()]),
+    ]
+
+    for bad in ['i32.bogus', ('i32.const',), ('local.get', 0, 1)]:
+        try:
+            builder.expression([bad])
+            assert False, 'Expected a TypeError.'
+        except TypeError:
+            pass
+
+
+def test_add_functions():
+    builder = Builder()
+    builder.add_function(['i32'], 'i32', [], [('local.get', 0)])
+
+    function_indexes, element_indexes = builder.add_functions([
+        (['i32'], 'i32', ['i64', 'i64'], [('local.get', 0)]),
+        {
+            'parameter_types': [],
+            'result_types': [],
+            'local_types': [],
+            'export_as': 'run',
+            'add_to_table': True,
+        },
+        ([], [], [], None, None, True),
+    ])
+
+    assert function_indexes == [1, 2, 3]
+    assert element_indexes == [None, 0, 1]
+    assert builder.function_annotations == [0, 0, 1, 1]
+    assert builder.function_element_indexes == [2, 3]
+    assert builder.tables[0].limits == parser.MinLimit(2)
+    assert builder.exports == [
+        parser.Export(name='run', descriptor=parser.ExportFunc(2)),
+    ]
+    assert builder.function_bodies[1].locals == [parser.Locals(2, 'i64')]
+
+    # Invalid batches don't change the builder.
+    for functions in [
+        [(['f64'], [], [], [], None, False, False, 'extra')],
+        [([], 'i64', [], [], 'a'), ([], [], [], [], 'a')],
+        [([], 'f32', [], [], 'run')],
+        [([], 'f64', [], []), ([], [], ['bad'], [])],
+    ]:
+        with pytest.raises((TypeError, ValueError)):
+            builder.add_functions(functions)
+    assert len(builder.function_types) == 2
+    assert len(builder.function_bodies) == 4
+    assert len(builder.exports) == 1
+
+    # So do single functions with an export name that is already used.
+    with pytest.raises(ValueError):
+        builder.add_function([], [], [], [], export_as='run')
+    assert len(builder.function_bodies) == 4
+    assert len(builder.exports) == 1
+
+
+def test_build_module_reuses_unchanged_sections():
+    builder = Builder()
+    builder.add_memory([1])
+    builder.add_global('var', 'i32', [('i32.const', 5)], export_as='counter')
+    builder.add_function(['i32'], 'i32', [], [('local.get', 0)], export_as='f')
+    builder.add_active_data_segment([parser.i32_const(8)], b'hello')
+
+    def build():
+        received = builder.build_module()
+        expected = Buffer().write_module(builder.build_module_tree()).getvalue()
+        assert received == expected
+        return received
+
+    first = build()
+    type_section = builder._encoded_sections['type']
+
+    builder.set_function_body(0, [('i32.const', 1)])
+    second = build()
+    assert second != first
+    assert builder._encoded_sections['type'] is type_section
+
+    # Items that are added or replaced directly are noticed.
+    builder.globals.append(
+        parser.Global(parser.GlobalType('i32', 'const'), [parser.i32_const(1)]),
+    )
+    third = build()
+    assert third != second
+    entry = builder.function_bodies[0]
+    builder.function_bodies[0] = entry._replace(expression=[parser.i32_const(2)])
+    fourth = build()
+    assert fourth != third
+
+    # Changes inside an item need invalidate.
+    builder.function_bodies[0].expression = [parser.i32_const(3)]
+    builder.invalidate('functions')
+    assert build() != fourth
+
+
+def test_build_module_with_imports():
+    builder = Builder()
+    builder.import_function('env', 'log', ['i32'], [])
+    builder.add_function([], [], [], [('i32.const', 7), ('call', 0)])
+
+    contents = builder.build_module()
+    module = parser.Module.parse(contents)
+    assert module.import_section == parser.ImportSection([
+        parser.Import('env', 'log', parser.ImportFunc(0)),
+    ])
+    assert Buffer().write_module(module).getvalue() == contents
+
+
+def test_fork():
+    base = Builder()
+    base.add_memory([1], export_as='memory')
+    base.add_global('const', 'i32', [('i32.const', 0)], export_as='tenant')
+    base.add_function([], 'i32', [], [('global.get', 0)], export_as='f')
+    base.add_passive_data_segment(b'base')
+    base_module = base.build_module()
+
+    fork = base.fork()
+    assert fork.function_bodies is base.function_bodies
+    assert fork.build_module() == base_module
+    assert fork._encoded_sections['code'] is base._encoded_sections['code']
+
+    fork.add_global('const', 'i32', [('i32.const', 7)], export_as='id')
+    fork.add_passive_data_segment(b'tenant')
+    fork.set_function_body(0, [('i32.const', 1)])
+
+    assert base.build_module() == base_module
+    assert len(base.globals) == 1 and len(base.exports) == 3
+    assert len(base.data_segments) == 1
+    assert base.function_bodies[0].expression == [parser.global_get(0)]
+    assert fork.function_bodies[0].expression == [parser.i32_const(1)]
+
+    # Changes to the base after the fork don't show up in the fork, either.
+    base.add_function([], [], [], export_as='g')
+    assert len(fork.function_bodies) == 1
+    assert fork.imports is base.imports
@@ -0,0 +1,101 @@
+from wasmtree import Buffer, Builder, parser
+from wasmtree.merger import merge
+
+
+def _module(imports=(), globals=(), functions=(), exports=(), start=None):
+    return parser.Module(
+        type_section=parser.TypeSection([
+            parser.FunctionType(['i32'], ['i32']),
+            parser.FunctionType([], []),
+        ]),
+        import_section=parser.ImportSection(list(imports)),
+        function_section=parser.FunctionSection([t for t, _ in functions]),
+        table_section=None,
+        memory_section=None,
+        global_section=parser.GlobalSection(list(globals)),
+        export_section=parser.ExportSection(list(exports)),
+        start_section=None if start is None else parser.StartSection(start),
+        element_section=None,
+        data_count_section=None,
+        code_section=parser.CodeSection([
+            parser.CodeEntry([], body) for _, body in functions
+        ]),
+        data_section=None,
+        custom1=[], custom2=None, custom3=None, custom4=None, custom5=None,
+        custom6=None, custom7=None, custom8=None, custom9=None, custom10=None,
+        custom11=None, custom12=None, custom13=[],
+    )
+
+
+def test_merge_links_imports_to_exports():
+    lib = _module(
+        imports=[parser.Import('env', 'log', parser.ImportFunc(1))],
+        globals=[
+            parser.Global(parser.GlobalType('i32', 'const'), [parser.i32_const(7)]),
+        ],
+        functions=[
+            (0, [parser.local_get(0), parser.call(2)]),
+            (0, [parser.local_get(0)]),
+            (1, []),
+        ],
+        exports=[
+            parser.Export('double', parser.ExportFunc(1)),
+            parser.Export('seven', parser.ExportGlobal(0)),
+        ],
+        start=3,
+    )
+    app = _module(
+        imports=[
+            parser.Import('env', 'log', parser.ImportFunc(1)),
+            parser.Import('lib', 'double', parser.ImportFunc(0)),
+            parser.Import('lib', 'seven', parser.ImportGlobal(
+                parser.GlobalType('i32', 'const'),
+            )),
+        ],
+        functions=[
+            (0, [parser.global_get(0), parser.call(1), parser.call(0)]),
+            (1, [parser.call(0)]),
+        ],
+        exports=[parser.Export('run', parser.ExportFunc(2))],
+        start=3,
+    )
+
+    module = merge({'lib': lib, 'app': app}, exports=['app'])
+
+    # Only the import that nothing satisfies is left.
+    assert module.import_section.imports == [
+        parser.Import('env', 'log', parser.ImportFunc(1)),
+    ]
+    assert module.code_section.entries[3].expression == [
+        parser.global_get(0),
+        parser.call(1),
+        parser.call(0),
+    ]
+    assert module.export_section.exports == [
+        parser.Export('run', parser.ExportFunc(4)),
+    ]
+
+    # Both start functions run, in order.
+    assert module.start_section == parser.StartSection(6)
+    assert module.code_section.entries[-1].expression == [
+        parser.call(3),
+        parser.call(5),
+    ]
+
+    contents = Buffer().write_module(module).getvalue()
+    received = parser.Module.parse(contents)
+    assert received.code_section == module.code_section
+    assert Buffer().write_module(received).getvalue() == contents
+
+
+def test_merge_rejects_mismatched_types():
+    lib = Builder()
+    lib.add_function([], [], [], [], export_as='f')
+    app = Builder()
+    app.import_function('lib', 'f', ['i32'], [])
+
+    try:
+        merge({'lib': lib, 'app': app})
+        assert False, 'Expected a ValueError.'
+    except ValueError:
+        pass
@@ -0,0 +1,354 @@
+from wasmtree import Builder, parser
+from wasmtree import module_optimizer
+
+
+def test_compact_data_segments():
+    builder = Builder()
+    builder.add_memory([1])
+    builder.add_active_data_segment([('i32.const', 8)], b'\x00\x00ab')
+    builder.add_active_data_segment([('i32.const', 12)], b'cd' + bytes(40) + b'ef\x00')
+    first = builder.add_passive_data_segment(b'xyz')
+    second = builder.add_passive_data_segment(b'xyz')
+    builder.add_active_data_segment([('i32.const', 1024)], bytes(100))
+    assert (first, second) == (2, 3)
+    builder.add_function([], [], [], [
+        ('i32.const', 0),
+        ('i32.const', 0),
+        ('i32.const', 3),
+        ('memory.init', second),
+    ])
+
+    module = builder.build_module_tree()
+    module_optimizer.compact_data_segments(module)
+
+    assert module.data_section.segments == [
+        parser.ActiveDataSegment([parser.i32_const(10)], b'abcd'),
+        parser.ActiveDataSegment([parser.i32_const(54)], b'ef'),
+        parser.PassiveDataSegment(b'xyz'),
+    ]
+    assert module.data_count_section == parser.DataCountSection(3)
+    assert module.code_section.entries[0].expression[-1] == parser.memory_init(2)
+
+
+def test_compact_data_segments_leaves_out_of_bounds_segments_alone():
+    # Segments that don't fit in the memory make instantiation trap, so
+    # trimming or dropping them would change what the module does.
+    for segments in [
+        [(65534, b'\x01' + bytes(40))],
+        [(0, b'a' + bytes(20)), (70000, bytes(20))],
+    ]:
+        builder = Builder()
+        builder.add_memory([1])
+        for offset, contents in segments:
+            builder.add_active_data_segment([('i32.const', offset)], contents)
+        expected = list(builder.data_segments)
+
+        builder.compact_data_segments()
+        assert builder.data_segments == expected
+
+
+def test_compact_data_segments_leaves_imported_memory_alone():
+    builder = Builder()
+    builder.import_memory('env', 'memory', [1])
+    builder.add_active_data_segment([('i32.const', 0)], b'\x00\x00a')
+    builder.add_active_data_segment([('i32.const', 3)], b'b')
+    expected = list(builder.data_segments)
+
+    builder.compact_data_segments()
+    assert builder.data_segments == expected
+
+
+def test_fold_identical_functions():
+    builder = Builder()
+
+    def add(export_as):
+        return builder.add_function(
+            ['i32'], 'i32', [], [('local.get', 0)],
+            export_as=export_as,
+            add_to_table=True,
+        )
+
+    add('a')
+    add('b')
+    builder.add_function([], 'i32', [], [('i32.const', 1), ('call', 0)])
+    builder.add_function([], 'i32', [], [('i32.const', 1), ('call', 1)])
+    builder.add_function([], [], [], [('ref.func', 3), 'drop'], export_as='c')
+
+    module = builder.build_module_tree()
+    module_optimizer.fold_identical_functions(module)
+
+    # Functions 0 and 1 are identical, which makes 2 and 3 identical too.
+    assert module.function_section.type_indexes == [0, 1, 2]
+    assert module.code_section.entries[1].expression == [
+        parser.i32_const(1),
+        parser.call(0),
+    ]
+    assert module.code_section.entries[2].expression[0] == parser.ref_func(1)
+    assert [e.descriptor.index for e in module.export_section.exports] == [0, 0, 2]
+    assert module.element_section.segments[0].function_indexes == [0, 0]
+
+
+def test_fold_identical_functions_after_imports():
+    builder = Builder()
+    builder.import_function('env', 'log', ['i32'], [])
+    builder.add_function([], [], [], [('i32.const', 1), ('call', 0)])
+    builder.add_function([], [], [], [('i32.const', 1), ('call', 0)])
+    builder.add_function([], [], [], [('call', 2)])
+
+    # The imported function is function 0, so the duplicate is function 2.
+    builder.start_function_index = 2
+    builder.optimize(fold_functions=True)
+
+    assert len(builder.function_bodies) == 2
+    assert builder.function_bodies[1].expression == [parser.call(1)]
+    assert builder.start_function_index == 1
+
+
+def test_coalesce_locals():
+    builder = Builder()
+    builder.add_function(['i32'], 'i32', ['i32', 'f64', 'i32', 'i32', 'f64'], [
+        # Local 1 is only used before local 3 is, so they can share a slot.
+        ('i32.const', 1),
+        ('local.set', 1),
+        ('local.get', 1),
+        ('local.set', 0),
+        ('i32.const', 2),
+        ('local.set', 3),
+        # Local 4 is never read.
+        ('local.get', 3),
+        ('local.tee', 4),
+        ('local.set', 4),
+        # Local 5 is read before it's written (so it reads zero), and then
+        # local 2 can reuse its slot.
+        ('local.get', 5),
+        'drop',
+        ('f64.const', 1.0),
+        ('local.set', 2),
+        ('local.get', 2),
+        'drop',
+        ('local.get', 0),
+    ])
+    builder.coalesce_locals()
+
+    entry = builder.function_bodies[0]
+    assert entry.locals == [
+        parser.Locals(count=1, type='i32'),
+        parser.Locals(count=1, type='f64'),
+    ]
+    assert entry.expression == builder.expression([
+        ('i32.const', 1),
+        ('local.set', 1),
+        ('local.get', 1),
+        ('local.set', 0),
+        ('i32.const', 2),
+        ('local.set', 1),
+        ('local.get', 1),
+        'drop',
+        ('local.get', 2),
+        'drop',
+        ('f64.const', 1.0),
+        ('local.set', 2),
+        ('local.get', 2),
+        'drop',
+        ('local.get', 0),
+    ])
+
+
+def test_coalesce_locals_in_loops():
+    builder = Builder()
+    builder.add_function([], [], ['i32', 'i32', 'i32'], [
+        ('Loop', 'empty', [
+            # Local 0 is carried from one iteration to the next.
+            ('local.get', 0),
+            ('i32.const', 1),
+            'i32.add',
+            ('local.set', 0),
+            # Local 1 is only used within one iteration.
+            ('i32.const', 2),
+            ('local.set', 1),
+            ('local.get', 1),
+            ('br_if', 0),
+            ('i32.const', 3),
+            ('local.set', 2),
+            ('local.get', 2),
+            ('br_if', 0),
+        ]),
+    ])
+    builder.coalesce_locals()
+
+    entry = builder.function_bodies[0]
+    assert entry.locals == [parser.Locals(count=2, type='i32')]
+    indexes = [
+        x.index for x in module_optimizer.iter_instructions(entry.expression)
+        if isinstance(x, (parser.local_get, parser.local_set))
+    ]
+    assert indexes == [0, 0, 1, 1, 1, 1]
+
+
+def test_remove_unused():
+    builder = Builder()
+    builder.import_function('env', 'unused', ['f64'], [])
+    builder.import_function('env', 'log', ['i32'], [])
+    builder.import_global('env', 'unused_global', 'const', 'i64')
+    builder.import_global('env', 'base', 'const', 'i32')
+    builder.add_global('const', 'i32', [('global.get', 1)])
+    builder.add_global('var', 'i32', [('i32.const', 0)])
+    builder.add_function([], [], [], [('i32.const', 1), ('call', 1)])
+    builder.add_function(['i64'], 'i64', [], [('local.get', 0)])
+    builder.add_function([], [], [], [
+        ('global.get', 2),
+        ('call', 1),
+        ('call', 2),
+    ], export_as='main')
+    builder.add_function([], [], [], [('ref.func', 2), 'drop'], add_to_table=True)
+    builder.add_function([], [], [], [], is_start_function=True)
+
+    builder.remove_unused()
+
+    assert [i.name for i in builder.imports] == ['log', 'base']
+    assert builder.globals == [
+        parser.Global(parser.GlobalType('i32', 'const'), [parser.global_get(0)]),
+    ]
+    assert builder.function_types == [
+        builder.function_type(['i32'], []),
+        builder.function_type([], []),
+    ]
+    assert builder.function_annotations == [1, 1, 1, 1]
+    assert [e.expression for e in builder.function_bodies[:2]] == [
+        [parser.i32_const(1), parser.call(0)],
+        [parser.global_get(1), parser.call(0), parser.call(1)],
+    ]
+    assert builder.exports == [parser.Export('main', parser.ExportFunc(2))]
+    assert builder.function_element_indexes == [3]
+    assert builder.start_function_index == 4
+
+
+def test_remove_unused_keeps_ref_func_declared():
+    builder = Builder()
+    builder.add_function([], [], [], [('ref.func', 1), 'drop'], export_as='main')
+    builder.add_function([], [], [], [])
+    builder.add_global('const', 'funcref', [('ref.func', 1)])
+
+    # The global was the only place that declared function 1.
+    builder.remove_unused()
+
+    assert builder.globals == []
+    assert builder.element_segments == [
+        parser.DeclarativeFuncRefSegment('funcref', [1]),
+    ]
+    module = parser.Module.parse(builder.build_module())
+    assert module.element_section.segments == builder.element_segments
+
+
+def test_propagate_constant_globals():
+    builder = Builder()
+    builder.import_global('env', 'base', 'const', 'i32')
+    builder.add_global('const', 'i32', [('i32.const', 10)])
+    builder.add_global('const', 'i32', [('global.get', 1)])
+    builder.add_global('var', 'i32', [('i32.const', 0)])
+    builder.add_global('const', 'f64', [('f64.const', 1.5)], export_as='pi')
+    builder.add_global('const', 'i32', [('global.get', 0)])
+    builder.add_memory([1])
+    builder.add_active_data_segment([('global.get', 2)], b'abc')
+    builder.add_function([], 'i32', [], [
+        ('global.get', 1),
+        ('global.get', 2),
+        'i32.add',
+        ('global.set', 3),
+        ('global.get', 4),
+        'drop',
+        ('global.get', 5),
+        ('global.get', 3),
+        'i32.add',
+    ])
+
+    builder.propagate_constant_globals()
+
+    # Globals 1 and 2 are gone. Global 4 is exported, so it's kept.
+    assert builder.globals == [
+        parser.Global(parser.GlobalType('i32', 'var'), [parser.i32_const(0)]),
+        parser.Global(parser.GlobalType('f64', 'const'), [parser.f64_const(1.5)]),
+        parser.Global(parser.GlobalType('i32', 'const'), [parser.global_get(0)]),
+    ]
+    assert builder.exports == [parser.Export('pi', parser.ExportGlobal(2))]
+    assert builder.data_segments[0].offset == [parser.i32_const(10)]
+    assert builder.function_bodies[0].expression == [
+        parser.i32_const(10),
+        parser.i32_const(10),
+        parser.i32_add(),
+        parser.global_set(1),
+        parser.f64_const(1.5),
+        parser.drop(),
+        parser.global_get(3),
+        parser.global_get(1),
+        parser.i32_add(),
+    ]
+
+
+def test_eliminate_common_subexpressions():
+    builder = Builder()
+    builder.add_function(['i32'], 'i32', ['i64'], [
+        ('local.get', 0), ('i32.const', 8), 'i32.add', ('i32.load', 2, 0),
+        ('local.get', 0), ('i32.const', 8), 'i32.add', ('i32.load', 2, 0),
+        'i32.add',
+    ])
+
+    builder.eliminate_common_subexpressions()
+
+    entry = builder.function_bodies[0]
+    assert entry.locals == [parser.Locals(1, 'i64'), parser.Locals(1, 'i32')]
+    assert entry.expression == [
+        parser.local_get(0),
+        parser.i32_const(8),
+        parser.i32_add(),
+        parser.local_tee(2),
+        parser.i32_load(2, 0),
+        parser.local_get(2),
+        parser.i32_load(2, 0),
+        parser.i32_add(),
+    ]
+
+
+def test_inline_functions():
+    builder = Builder()
+    builder.add_function(['i32', 'i32'], 'i32', ['i64'], [
+        ('local.get', 0),
+        ('If', 'empty', [('local.get', 1), 'ret'], None),
+        ('local.get', 0),
+    ])
+    builder.add_function([], 'i32', [], [('i32.const', 7), ('call', 2)])
+    builder.add_function(['i32'], 'i32', [], [
+        ('local.get', 0), ('call', 1), 'i32.add',
+    ])
+    builder.add_function(['f64'], [], [], [
+        ('i32.const', 1),
+        ('i32.const', 2),
+        ('call', 0),
+        'drop',
+    ], export_as='main')
+
+    builder.inline_functions()
+
+    # Functions 1 and 2 call each other, so they're left alone.
+    assert builder.function_bodies[1].expression[-1] == parser.call(2)
+    assert builder.function_bodies[2].expression[-2] == parser.call(1)
+
+    entry = builder.function_bodies[3]
+    assert entry.locals == [
+        parser.Locals(count=2, type='i32'),
+        parser.Locals(count=1, type='i64'),
+    ]
+    assert entry.expression == builder.expression([
+        ('i32.const', 1),
+        ('i32.const', 2),
+        ('local.set', 2),
+        ('local.set', 1),
+        ('i64.const', 0),
+        ('local.set', 3),
+        ('Block', 'i32', [
+            ('local.get', 1),
+            ('If', 'empty', [('local.get', 2), ('br', 1)], None),
+            ('local.get', 1),
+        ]),
+        'drop',
+    ])
@@ -0,0 +1,326 @@
+import math
+
+from wasmtree import optimizer, parser
+
+
+def _fold(*instructions):
+    return optimizer.run(list(instructions))
+
+
+def test_fold_integer_operators():
+    i32, i64 = parser.i32_const, parser.i64_const
+
+    assert _fold(i32(0x7FFFFFFF), i32(1), parser.i32_add()) == [i32(-2 ** 31)]
+    assert _fold(i32(-7), i32(2), parser.i32_rem_s()) == [i32(-1)]
+    assert _fold(i32(-8), i32(2), parser.i32_div_u()) == [i32(0x7FFFFFFC)]
+    assert _fold(i32(1), i32(33), parser.i32_shl()) == [i32(2)]
+    assert _fold(i32(1), i32(-1), parser.i32_rotr()) == [i32(2)]
+    assert _fold(i64(-1), i64(0), parser.i64_lt_u()) == [i32(0)]
+    assert _fold(i64(0), parser.i64_clz()) == [i64(64)]
+    assert _fold(i32(0x80), parser.i32_extend8_s()) == [i32(-128)]
+    assert _fold(i32(-1), parser.i64_extend_i32_u()) == [i64(0xFFFFFFFF)]
+    assert _fold(i64(2 ** 32 + 5), parser.i32_wrap_i64()) == [i32(5)]
+
+    # Operators that trap are left alone.
+    for instructions in [
+        [i32(1), i32(0), parser.i32_div_s()],
+        [i32(-2 ** 31), i32(-1), parser.i32_div_s()],
+        [i64(1), i64(0), parser.i64_rem_u()],
+    ]:
+        assert _fold(*instructions) == instructions
+
+
+def test_fold_float_operators():
+    f32, f64 = parser.f32_const, parser.f64_const
+
+    assert _fold(f32(0.1), f32(0.2), parser.f32_add()) == [f32(0.30000001192092896)]
+    assert _fold(f64(1.0), f64(-0.0), parser.f64_div()) == [f64(-math.inf)]
+    assert _fold(f64(0.0), f64(-0.0), parser.f64_min()) == [f64(-0.0)]
+    assert math.copysign(1, _fold(f64(-0.4), parser.f64_nearest())[0].number) < 0
+    assert _fold(f64(2.5), parser.f64_nearest()) == [f64(2.0)]
+    assert _fold(f64(1e39), parser.f32_demote_f64()) == [f32(math.inf)]
+    assert _fold(f64(math.nan), f64(1.0), parser.f64_ne()) == [parser.i32_const(1)]
+
+    # Results that are NaN are left alone.
+    instructions = [f32(0.0), f32(0.0), parser.f32_div()]
+    assert _fold(*instructions) == instructions
+
+
+def test_fold_conversions():
+    i32, i64 = parser.i32_const, parser.i64_const
+
+    assert _fold(parser.f64_const(-1.9), parser.i32_trunc_f64_s()) == [i32(-1)]
+    assert _fold(parser.f64_const(3e9), parser.i32_trunc_f64_u()) == [i32(-1294967296)]
+    assert _fold(parser.f64_const(3e9), parser.i32_trunc_sat_f64_s()) == [i32(2 ** 31 - 1)]
+    assert _fold(parser.f32_const(math.nan), parser.i64_trunc_sat_f32_u()) == [i64(0)]
+    assert _fold(parser.f32_const(1.0), parser.i32_reinterpret_f32()) == [i32(0x3F800000)]
+    assert _fold(i32(-1), parser.f64_convert_i32_u()) == [parser.f64_const(2 ** 32 - 1)]
+
+    # Converting to f32 rounds once, rather than rounding to f64 first.
+    assert _fold(i64(2 ** 53 + 2 ** 29 + 1), parser.f32_convert_i64_s()) == [
+        parser.f32_const(float(2 ** 53 + 2 ** 30)),
+    ]
+
+    instructions = [parser.f64_const(3e9), parser.i32_trunc_f64_s()]
+    assert _fold(*instructions) == instructions
+
+
+def test_eliminate_dead_code():
+    expression = [
+        parser.Block('empty', [
+            parser.local_get(0),
+            parser.If('empty', [parser.br(1), parser.call(0)], None),
+            parser.Loop('empty', [parser.nop()]),
+            parser.ret(),
+            parser.i32_const(1),
+            parser.drop(),
+        ]),
+        parser.call(2),
+        parser.If('empty', [parser.nop()], []),
+        parser.unreachable(),
+        parser.call(1),
+    ]
+    assert optimizer.run(expression) == [
+        parser.Block('empty', [
+            parser.local_get(0),
+            parser.If('empty', [parser.br(1)], None),
+            parser.ret(),
+        ]),
+        parser.call(2),
+        parser.drop(),
+        parser.unreachable(),
+    ]
+
+
+def test_rules_apply_to_their_own_results():
+    expression = [
+        parser.local_get(0),
+        parser.i32_const(2),
+        parser.i32_const(3),
+        parser.nop(),
+        parser.i32_add(),
+        parser.i32_const(5),
+        parser.i32_eq(),
+        parser.i32_eqz(),
+        parser.i32_eq(),
+        parser.i32_eqz(),
+        parser.local_set(1),
+        parser.local_get(1),
+    ]
+    assert optimizer.run(expression) == [
+        parser.local_get(0),
+        parser.i32_const(0),
+        parser.i32_ne(),
+        parser.local_tee(1),
+    ]
+
+
+def test_strength_reduction():
+    i32, i64 = parser.i32_const, parser.i64_const
+    x = parser.local_get(0)
+
+    assert optimizer.run([x, i32(8), parser.i32_mul()]) == [
+        x, i32(3), parser.i32_shl(),
+    ]
+    assert optimizer.run([x, i64(-2 ** 63), parser.i64_mul()]) == [
+        x, i64(63), parser.i64_shl(),
+    ]
+    assert optimizer.run([x, i32(16), parser.i32_div_u()]) == [
+        x, i32(4), parser.i32_shr_u(),
+    ]
+    assert optimizer.run([x, i64(4), parser.i64_rem_u()]) == [
+        x, i64(3), parser.i64_and(),
+    ]
+
+    # These are left alone.
+    for instructions in [
+        [x, i32(6), parser.i32_mul()],
+        [x, i32(7), parser.i32_div_s()],
+    ]:
+        assert optimizer.run(instructions) == instructions
+
+
+def test_expand_divisions():
+    i32, i64 = parser.i32_const, parser.i64_const
+    x = parser.local_get(0)
+
+    assert optimizer.expand_divisions([x, i32(-4), parser.i32_div_s()]) == [
+        i32(0),
+        x, x, i32(31), parser.i32_shr_s(), i32(30), parser.i32_shr_u(),
+        parser.i32_add(), i32(2), parser.i32_shr_s(),
+        parser.i32_sub(),
+    ]
+    assert optimizer.expand_divisions([x, i32(7), parser.i32_div_s()]) == [
+        x,
+        parser.i64_extend_i32_s(),
+        i64(2454267027),
+        parser.i64_mul(),
+        i64(34),
+        parser.i64_shr_s(),
+        parser.i32_wrap_i64(),
+        x, i32(31), parser.i32_shr_u(),
+        parser.i32_add(),
+    ]
+
+    # These are left alone.
+    for instructions in [
+        [x, i64(7), parser.i64_div_s()],
+        [parser.call(0), i32(7), parser.i32_div_s()],
+    ]:
+        assert optimizer.expand_divisions(instructions) == instructions
+
+
+def test_algebraic_identities():
+    i32, i64 = parser.i32_const, parser.i64_const
+    x, y = parser.local_get(0), parser.local_get(1)
+
+    assert optimizer.run([
+        x,
+        i32(0), parser.i32_add(),
+        i32(1), parser.i32_mul(),
+        i32(-1), parser.i32_and(),
+        i32(0), parser.i32_xor(),
+        i32(32), parser.i32_shl(),
+        i32(1), parser.i32_div_s(),
+    ]) == [x]
+    assert optimizer.run([x, i64(0), parser.i64_or(), i64(64), parser.i64_rotr()]) == [x]
+
+    assert optimizer.run([x, x, y, parser.select()]) == [x]
+    assert optimizer.run([x, parser.i32_eqz(), parser.i32_eqz(), parser.br_if(0)]) == [
+        x, parser.br_if(0),
+    ]
+
+    # These are left alone.
+    for instructions in [
+        [x, i32(1), parser.i32_add()],
+        [x, parser.f32_const(0.0), parser.f32_add()],
+        [x, y, y, parser.select()],
+        [x, x, parser.call(0), parser.select()],
+    ]:
+        assert optimizer.run(instructions) == instructions
+
+
+def test_fold_constant_addresses():
+    i32 = parser.i32_const
+    x = parser.local_get(0)
+
+    instructions = [
+        x, i32(16), parser.i32_add(), parser.i64_load(3, 4),
+        x, i32(8), parser.i32_add(), parser.f32_const(1.0), parser.f32_store(2, 0),
+    ]
+    assert optimizer.run(instructions, assume_no_wrap=True) == [
+        x, parser.i64_load(3, 20),
+        x, parser.f32_const(1.0), parser.f32_store(2, 8),
+    ]
+
+    # By default, the address must be small enough that it can't wrap around.
+    assert optimizer.run(instructions) == instructions
+    assert optimizer.run([
+        x, i32(0xFFFF), parser.i32_and(), i32(16), parser.i32_add(),
+        parser.i32_load(2, 0),
+    ]) == [
+        x, i32(0xFFFF), parser.i32_and(), parser.i32_load(2, 16),
+    ]
+
+    # Negative constants are left alone.
+    instructions = [x, i32(-4), parser.i32_add(), parser.i32_load(2, 8)]
+    assert optimizer.run(instructions, assume_no_wrap=True) == instructions
+    instructions = [
+        x, i32(-1), parser.i32_and(), i32(4), parser.i32_add(),
+        parser.i32_load(2, 0),
+    ]
+    assert optimizer.run(instructions) == [
+        x, i32(4), parser.i32_add(), parser.i32_load(2, 0),
+    ]
+
+
+def test_propagate_locals():
+    get, set, tee = parser.local_get, parser.local_set, parser.local_tee
+    expression = [
+        get(0),
+        set(1),
+        get(1),
+        get(1),
+        parser.i32_add(),
+        set(2),
+        # Local 2 is written again before it's read, so the first write is
+        # dead.
+        get(1),
+        tee(2),
+        parser.call(0),
+        parser.Block('empty', [get(1), set(3), get(3), parser.br_if(0)]),
+        # The block may have changed local 1. Local 3 isn't read after it's
+        # copied, so the write is dead.
+        get(1),
+        set(3),
+        get(2),
+        get(3),
+        parser.i32_add(),
+    ]
+    assert optimizer.propagate_locals(expression) == [
+        get(0),
+        set(1),
+        get(0),
+        get(0),
+        parser.i32_add(),
+        parser.drop(),
+        get(0),
+        tee(2),
+        parser.call(0),
+        parser.Block('empty', [get(1), set(3), get(1), parser.br_if(0)]),
+        get(1),
+        parser.drop(),
+        get(2),
+        get(1),
+        parser.i32_add(),
+    ]
+
+    # Writes just before the end of the function are never read.
+    assert optimizer.run(optimizer.propagate_locals([
+        get(0), set(1), get(1), parser.ret(),
+    ])) == [get(0), parser.ret()]
+
+
+def test_eliminate_common_subexpressions():
+    get, set, tee = parser.local_get, parser.local_set, parser.local_tee
+    i32 = parser.i32_const
+    load, store = parser.i32_load(2, 0), parser.i32_store(2, 0)
+    expression = [
+        get(0), i32(8), parser.i32_add(), load,
+        get(0), i32(8), parser.i32_add(), load,
+        parser.i32_add(),
+        set(1),
+        get(0), i32(8), parser.i32_add(), get(1), store,
+        get(1),
+        set(0),
+        # Local 0 has changed, so its address is different now.
+        get(0), i32(8), parser.i32_add(), load,
+        parser.drop(),
+        parser.Loop('empty', [
+            get(0), i32(4), parser.i32_mul(), parser.drop(),
+            get(0), i32(4), parser.i32_mul(), parser.drop(),
+        ]),
+    ]
+    assert optimizer.eliminate_common_subexpressions(expression, 2) == ([
+        get(0), i32(8), parser.i32_add(), tee(2), load,
+        get(2), load,
+        parser.i32_add(),
+        set(1),
+        get(2), get(1), store,
+        get(1),
+        set(0),
+        get(0), i32(8), parser.i32_add(), load,
+        parser.drop(),
+        parser.Loop('empty', [
+            get(0), i32(4), parser.i32_mul(), tee(3), parser.drop(),
+            get(3), parser.drop(),
+        ]),
+    ], ['i32', 'i32'])
+
+    # Computations that are this small aren't worth a local.
+    expression = [
+        get(0), parser.i32_eqz(), get(0), parser.i32_eqz(), parser.i32_add(),
+    ]
+    assert optimizer.eliminate_common_subexpressions(expression, 1) == (
+        expression, [],
+    )
@@ -0,0 +1,140 @@
+import concurrent.futures
+
+import pytest
+
+from wasmtree import Builder, Buffer, parser, passes
+
+
+def _module():
+    builder = Builder()
+    builder.add_function(['i32'], 'i32', [], [
+        ('local.get', 0), ('i32.const', 0), 'i32.add',
+    ])
+    builder.add_function([], 'i32', [], [
+        ('i32.const', 2), ('i32.const', 3), 'i32.mul', ('call', 0), 'nop',
+    ], export_as='f')
+    return builder.build_module_tree()
+
+
+def test_run_preset():
+    module = _module()
+    size = len(Buffer().write_module(module).getvalue())
+    report = passes.run(module, 'O2')
+
+    assert module.code_section.entries == [
+        parser.CodeEntry(
+            [parser.Locals(count=1, type='i32')],
+            [
+                parser.i32_const(6),
+                parser.local_set(0),
+                parser.Block('i32', [parser.local_get(0)]),
+            ],
+        ),
+    ]
+    assert report.iterations == 2
+    assert list(report.passes) == passes.presets['O2']
+    assert report.passes['peephole'].runs == 2
+    assert report.passes['remove_unused'].instructions_removed == 1
+    assert report.bytes_saved == size - len(Buffer().write_module(module).getvalue())
+
+    # The columns line up, even with long pass names.
+    lines = str(report).splitlines()[:-1]
+    assert len({len(line) for line in lines}) == 1
+
+
+def test_run_passes():
+    module = _module()
+    calls = []
+
+    def count_calls(module):
+        calls.append(len(module.code_section.entries))
+
+    report = passes.run(module, ['peephole', count_calls], max_iterations=1)
+    assert calls == [2]
+    assert report.passes['peephole'].instructions_removed == 5
+    assert report.passes['count_calls'].bytes_saved == 0
+
+    with pytest.raises(ValueError):
+        passes.run(module, ['unknown'])
+    with pytest.raises(ValueError):
+        passes.run(module, 'O9')
+
+
+def test_run_on_executor():
+    expected = _module()
+    expected_report = passes.run(expected, 'O1')
+
+    module = _module()
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        report = passes.run(module, 'O1', executor=executor)
+
+    assert Buffer().write_module(module).getvalue() == (
+        Buffer().write_module(expected).getvalue()
+    )
+    assert report.instructions_removed == expected_report.instructions_removed
+    assert report.bytes_saved == expected_report.bytes_saved
+
+
+def test_builder_optimize_with_workers():
+    def build():
+        builder = Builder()
+        for i in range(300):
+            builder.add_function([], 'i32', [], [
+                ('i32.const', i), ('i32.const', 1), 'i32.add', 'nop',
+            ], export_as=f'f{i}')
+        return builder
+
+    builder = build()
+    report = builder.optimize(workers=2)
+    expected = build()
+    expected.optimize()
+
+    assert report.instructions_removed == 900
+    assert builder.build_module() == expected.build_module()
+    assert builder.function_bodies[5].expression == [parser.i32_const(6)]
+
+
+def test_builder_optimize_with_workers_and_no_locals():
+    # Bodies are sent to the workers encoded. Without locals, one that starts
+    # with i32.const -1 (41 7F) looks like a run of locals.
+    def build():
+        builder = Builder()
+        for i in range(300):
+            builder.add_function(['i32'], 'i32', [], [
+                ('i32.const', -1 - i), ('local.get', 0), 'i32.add', 'nop',
+            ], export_as=f'f{i}')
+        return builder
+
+    builder = build()
+    builder.optimize(workers=2)
+    expected = build()
+    expected.optimize()
+
+    assert builder.build_module() == expected.build_module()
+    assert builder.function_bodies[0] == parser.CodeEntry([], [
+        parser.i32_const(-1), parser.local_get(0), parser.i32_add(),
+    ])
+
+
+def test_run_assuming_no_wrap():
+    def build():
+        builder = Builder()
+        builder.add_memory([1])
+        builder.add_function(['i32'], 'i32', [], [
+            ('local.get', 0), ('i32.const', 8), 'i32.add', ('i32.load', 2, 0),
+        ])
+        return builder.build_module_tree()
+
+    module = build()
+    passes.run(module, ['peephole'])
+    assert module.code_section.entries == build().code_section.entries
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        passes.run(module, ['peephole'], executor=executor, assume_no_wrap=True)
+    assert module.code_section.entries[0].expression == [
+        parser.local_get(0), parser.i32_load(2, 8),
+    ]
+
+    # Folding without the guard isn't a pass of its own.
+    with pytest.raises(ValueError):
+        passes.run(module, ['fold_constant_addresses'])
@@ -0,0 +1,98 @@
+import pytest
+
+from wasmtree import Buffer, Builder, parser
+from wasmtree.reader import LazyCodeEntry, read_code_entry, read_module
+
+
+def _build_module():
+    builder = Builder()
+    builder.import_function('env', 'log', ['i32'], [])
+    builder.add_memory([1], export_as='memory')
+    builder.add_global('var', 'i32', [('i32.const', -5)])
+    for i in range(3):
+        builder.add_function(
+            ['i32'], 'i32', ['i64'],
+            [('local.get', 0), ('i32.const', i), 'i32.add'],
+            export_as=f'f{i}',
+            add_to_table=True,
+        )
+    builder.add_active_data_segment([('i32.const', 11)], b'hello')
+    builder.add_passive_data_segment(b'world')
+    builder.add_custom_section('extra', b'\x01\x02')
+    return builder.build_module()
+
+
+def test_read_module():
+    contents = _build_module()
+    module = read_module(contents)
+
+    entries = module.code_section.entries
+    assert all(isinstance(e, LazyCodeEntry) for e in entries)
+    assert not any(e.is_decoded for e in entries)
+    assert bytes(module.data_section.segments[1].contents) == b'world'
+
+    # Writing the module doesn't decode the function bodies.
+    assert Buffer().write_module(module).getvalue() == contents
+    assert not any(e.is_decoded for e in entries)
+
+    assert entries[1].expression == [
+        parser.local_get(0),
+        parser.i32_const(1),
+        parser.i32_add(),
+    ]
+    assert parser.Module.parse(contents).code_section.entries == entries
+
+
+def test_builder_from_module():
+    contents = _build_module()
+    builder = Builder.from_module(contents)
+    assert builder.build_module() == contents
+
+    # Imported functions come first in the function index space.
+    function_index, element_index = builder.add_function(
+        [], [], [], [('i32.const', 0), ('call', 0)],
+        add_to_table=True,
+    )
+    assert (function_index, element_index) == (4, 3)
+
+    builder.set_function_body(2, [('i32.const', 7)])
+    bodies = builder.function_bodies
+    assert not isinstance(bodies[1], LazyCodeEntry)
+    assert not bodies[0].is_decoded and not bodies[2].is_decoded
+
+    module = parser.Module.parse(builder.build_module())
+    assert module.code_section.entries[1].expression == [parser.i32_const(7)]
+    assert module.table_section.table_types[0].limits == parser.MinLimit(4)
+    assert module.element_section.segments[-1] == parser.DefaultSegment(
+        offset=[parser.i32_const(3)],
+        function_indexes=[4],
+    )
+    assert Builder.from_module(module).build_module() == builder.build_module()
+
+
+def test_read_code_entry_without_locals():
+    # Without locals, a body starting with i32.const -1 (41 7F) looks like a
+    # run of 65 i32 locals.
+    entry = parser.CodeEntry([], [
+        parser.i32_const(-1), parser.local_get(0), parser.i32_add(),
+    ])
+    contents = Buffer().write_code_entry(entry).getvalue()
+    assert read_code_entry(contents) == entry
+    assert LazyCodeEntry(memoryview(contents)).locals == []
+
+
+def test_builder_from_module_with_imported_table():
+    builder = Builder()
+    builder.import_table('env', 'table', 'funcref', [2])
+    builder.add_table('funcref', [5])
+    builder.add_function([], [], [], [])
+    contents = builder.build_module()
+
+    # Table 0 is the imported table, which the builder can't grow.
+    builder = Builder.from_module(contents)
+    with pytest.raises(ValueError):
+        builder.add_function([], [], [], [], add_to_table=True)
+    with pytest.raises(ValueError):
+        builder.add_functions([([], [], [], [], None, True)])
+    assert len(builder.function_bodies) == 1
+    assert builder.build_module() == contents
@@ -53,3 +53,61 @@ def test_code_section():
     contents = Buffer().write_code_section(expected).getvalue()
     received = parser.CodeSection.parse(contents)
     assert received == expected
+
+
+def test_data_section():
+    expected = parser.DataSection([
+        parser.ActiveDataSegment(
+            offset=[parser.i32_const(16)],
+            contents=b'\x01\x02\x03',
+        ),
+        parser.PassiveDataSegment(contents=b'hello' * 100),
+        parser.ActiveIndexDataSegment(
+            index=0,
+            offset=[parser.i32_const(1024)],
+            contents=b'',
+        ),
+    ])
+    contents = Buffer().write_data_section(expected).getvalue()
+    received = parser.DataSection.parse(contents)
+    assert received == expected
+
+    # Buffer-protocol contents are encoded exactly like bytes.
+    segments = [
+        parser.PassiveDataSegment(contents=memoryview(bytearray(b'hello'))),
+    ]
+    contents = Buffer().write_data_section(parser.DataSection(segments))
+    received = parser.DataSection.parse(contents.getvalue())
+    assert received.segments == [parser.PassiveDataSegment(contents=b'hello')]
+
+
+def test_import_section():
+    expected = parser.ImportSection([
+        parser.Import('env', 'log', parser.ImportFunc(0)),
+        parser.Import(
+            'env',
+            'memory',
+            parser.ImportMemory(parser.MemoryType(parser.MinLimit(1))),
+        ),
+    ])
+    contents = Buffer().write_import_section(expected).getvalue()
+    received = parser.ImportSection.parse(contents)
+    assert received == expected
+
+
+def test_prefixed_and_reference_instructions():
+    expected = parser.CodeSection([
+        parser.CodeEntry(
+            locals=[],
+            expression=[
+                parser.ref_func(0),
+                parser.drop(),
+                parser.data_drop(0),
+                parser.memory_fill(),
+                parser.select_t(['i64']),
+            ],
+        ),
+    ])
+    contents = Buffer().write_code_section(expected).getvalue()
+    received = parser.CodeSection.parse(contents)
+    assert received == expected
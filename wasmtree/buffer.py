@@ -6,6 +6,9 @@ class Buffer:
     def __init__(self):
         self._buffer = io.BytesIO()
 
+    def getbuffer(self):
+        return self._buffer.getbuffer()
+
     def getvalue(self):
         return self._buffer.getvalue()
 
@@ -20,24 +23,28 @@ class Buffer:
 
     def write_byte(self, value):
         assert isinstance(value, int) and 0 <= value < 256
-        self.write_bytes(value.to_bytes(1, byteorder='big'))
+        self._buffer.write(_single_bytes[value])
         return self
 
     def write_bytes(self, value):
-        assert isinstance(value, bytes)
+        assert isinstance(value, (bytes, bytearray, memoryview))
         self._buffer.write(value)
         return self
 
     def write_code_section(self, code_section):
-        if code_section and code_section.entries:
-            stage = Buffer()
-            stage.write_u32(len(code_section.entries))
-            for entry in code_section.entries:
-                stage.write_code_entry(entry)
-            self._write_staged_section(code_section.id, stage)
+        if code_section:
+            self.write_vec_section(
+                code_section.id, code_section.entries, Buffer.write_code_entry)
         return self
 
     def write_code_entry(self, entry):
+        # Entries that were read lazily (and never decoded) keep their original
+        # encoding, including the size.
+        encoded = getattr(entry, 'encoded', None)
+        if encoded is not None:
+            self.write_bytes(encoded)
+            return self
+
         stage = Buffer()
         stage.write_u32(len(entry.locals))
 
@@ -46,9 +53,9 @@ class Buffer:
             stage.write_type(locals.type)
 
         stage.write_expression(entry.expression)
-        staged_bytes = stage.getvalue()
-        self.write_u32(len(staged_bytes))
-        self.write_bytes(staged_bytes)
+        with stage.getbuffer() as staged_bytes:
+            self.write_u32(staged_bytes.nbytes)
+            self.write_bytes(staged_bytes)
         return self
 
     def write_custom_sections(self, custom_sections):
@@ -73,69 +80,89 @@ class Buffer:
 
     def write_data_section(self, data_section):
         if data_section and data_section.segments:
-            stage = Buffer()
-            stage.write_u32(len(data_section.segments))
+            # Data segments are usually the bulk of a module, so don't stage
+            # them. Encode the (small) segment headers up front, so that the
+            # section size is known, and then write each segment's contents
+            # straight into this buffer.
+            count = Buffer().write_u32(len(data_section.segments)).getvalue()
+            size = len(count)
+            segments = []
 
             for segment in data_section.segments:
-                stage.write_byte(segment.id)
+                contents = _byte_view(segment.contents)
+                header = Buffer().write_byte(segment.id)
                 if segment.id == 0x00:
-                    self.write_expression(segment.offset)
+                    header.write_expression(segment.offset)
                 elif segment.id == 0x02:
-                    self.write_u32(segment.index)
-                    self.write_expression(segment.offset)
-                self.write_u32(len(segment.contents))
-                self.write_bytes(segment.contents)
+                    header.write_u32(segment.index)
+                    header.write_expression(segment.offset)
+                header.write_u32(contents.nbytes)
+                header = header.getvalue()
+                size += len(header) + contents.nbytes
+                segments.append((header, contents))
+
+            self.write_byte(data_section.id)
+            self.write_u32(size)
+            self.write_bytes(count)
+
+            for header, contents in segments:
+                self.write_bytes(header)
+                with contents:
+                    self.write_bytes(contents)
 
-            self._write_staged_section(data_section.id, stage)
         return self
 
     def write_element_section(self, element_section):
-        if element_section and element_section.segments:
-            stage = Buffer()
-            stage.write_u32(len(element_section.segments))
-            for segment in element_section.segments:
-                stage.write_byte(segment.id)
+        if element_section:
+            self.write_vec_section(
+                element_section.id,
+                element_section.segments,
+                Buffer.write_element_segment,
+            )
+        return self
 
-                if segment.id == 0x00:
-                    stage.write_expression(segment.offset)
-                    stage.write_vec_u32(segment.function_indexes)
+    def write_element_segment(self, segment):
+        self.write_byte(segment.id)
 
-                elif segment.id == 0x01:
-                    stage.write_byte(0x00)
-                    stage.write_vec_u32(segment.function_indexes)
+        if segment.id == 0x00:
+            self.write_expression(segment.offset)
+            self.write_vec_u32(segment.function_indexes)
 
-                elif segment.id == 0x02:
-                    stage.write_u32(segment.table_index)
-                    stage.write_expression(segment.offset)
-                    stage.write_byte(0x00)
-                    stage.write_vec_u32(segment.function_indexes)
+        elif segment.id == 0x01:
+            self.write_byte(0x00)
+            self.write_vec_u32(segment.function_indexes)
+
+        elif segment.id == 0x02:
+            self.write_u32(segment.table_index)
+            self.write_expression(segment.offset)
+            self.write_byte(0x00)
+            self.write_vec_u32(segment.function_indexes)
 
-                elif segment.id == 0x03:
-                    stage.write_byte(0x00)
-                    stage.write_vec_u32(segment.function_indexes)
+        elif segment.id == 0x03:
+            self.write_byte(0x00)
+            self.write_vec_u32(segment.function_indexes)
 
-                elif segment.id == 0x04:
-                    stage.write_expression(segment.offset)
-                    stage.write_vec_expression(segment.initializers)
+        elif segment.id == 0x04:
+            self.write_expression(segment.offset)
+            self.write_vec_expression(segment.initializers)
 
-                elif segment.id == 0x05:
-                    stage.write_type(segment.type)
-                    stage.write_vec_expression(segment.initializers)
+        elif segment.id == 0x05:
+            self.write_type(segment.type)
+            self.write_vec_expression(segment.initializers)
 
-                elif segment.id == 0x06:
-                    stage.write_u32(segment.table_index)
-                    stage.write_expression(segment.offset)
-                    stage.write_type(segment.type)
-                    stage.write_vec_expression(segment.intializers)
+        elif segment.id == 0x06:
+            self.write_u32(segment.table_index)
+            self.write_expression(segment.offset)
+            self.write_type(segment.type)
+            self.write_vec_expression(segment.initializers)
 
-                elif segment.id == 0x07:
-                    stage.write_type(segment.type)
-                    stage.write_vec_expression(segment.intializers)
+        elif segment.id == 0x07:
+            self.write_type(segment.type)
+            self.write_vec_expression(segment.initializers)
 
-                else:
-                    raise NotImplementedError(str(segment))
+        else:
+            raise NotImplementedError(str(segment))
 
-            self._write_staged_section(element_section.id, stage)
         return self
 
     def write_export(self, export):
@@ -145,12 +172,9 @@ class Buffer:
         return self
 
     def write_export_section(self, export_section):
-        if export_section and export_section.exports:
-            stage = Buffer()
-            stage.write_u32(len(export_section.exports))
-            for export in export_section.exports:
-                stage.write_export(export)
-            self._write_staged_section(export_section.id, stage)
+        if export_section:
+            self.write_vec_section(
+                export_section.id, export_section.exports, Buffer.write_export)
         return self
 
     def write_expression(self, expression):
@@ -168,10 +192,12 @@ class Buffer:
         return self
 
     def write_function_section(self, function_section):
-        if function_section and function_section.type_indexes:
-            stage = Buffer()
-            stage.write_vec_u32(function_section.type_indexes)
-            self._write_staged_section(function_section.id, stage)
+        if function_section:
+            self.write_vec_section(
+                function_section.id,
+                function_section.type_indexes,
+                Buffer.write_u32,
+            )
         return self
 
     def write_global(self, glob):
@@ -180,12 +206,9 @@ class Buffer:
         return self
 
     def write_global_section(self, global_section):
-        if global_section and global_section.globals:
-            stage = Buffer()
-            stage.write_u32(len(global_section.globals))
-            for glob in global_section.globals:
-                stage.write_global(glob)
-            self._write_staged_section(global_section.id, stage)
+        if global_section:
+            self.write_vec_section(
+                global_section.id, global_section.globals, Buffer.write_global)
         return self
 
     def write_global_type(self, global_type):
@@ -235,11 +258,9 @@ class Buffer:
         return self
 
     def write_import_section(self, import_section):
-        if import_section and import_section.imports:
-            stage = Buffer()
-            for imp in import_section.imports:
-                stage.write_import(imp)
-            self._write_staged_section(import_section.id, stage)
+        if import_section:
+            self.write_vec_section(
+                import_section.id, import_section.imports, Buffer.write_import)
         return self
 
     def write_instruction(self, instr):
@@ -277,12 +298,12 @@ class Buffer:
         elif instr_id == 0xD0:
             self.write_type(instr.type)
 
-        elif instr_id == 0xD1:
+        elif instr_id == 0xD2:
             self.write_u32(instr.function)
 
         elif instr_id == 0x1C:
-            self.write_u32(len(intr.types))
-            for type in intsr.types:
+            self.write_u32(len(instr.types))
+            for type in instr.types:
                 self.write_type(type)
 
         elif 0x20 <= instr_id <= 0x26:
@@ -308,11 +329,11 @@ class Buffer:
             self.write_f64(instr.number)
 
         elif instr_id == 0xFC:
-            self.write_u32(intr.code)
+            self.write_u32(instr.code)
 
             if instr.code == 0x08:
                 self.write_u32(instr.data_index)
-                self.wite_byte(instr.zero)
+                self.write_byte(instr.zero)
 
             elif instr.code == 0x09:
                 self.write_u32(instr.data_index)
@@ -350,12 +371,12 @@ class Buffer:
         return self
 
     def write_memory_section(self, memory_section):
-        if memory_section and memory_section.memory_types:
-            stage = Buffer()
-            stage.write_u32(len(memory_section.memory_types))
-            for memory_type in memory_section.memory_types:
-                stage.write_memory_type(memory_type)
-            self._write_staged_section(memory_section.id, stage)
+        if memory_section:
+            self.write_vec_section(
+                memory_section.id,
+                memory_section.memory_types,
+                Buffer.write_memory_type,
+            )
         return self
 
     def write_memory_type(self, memory_type):
@@ -419,12 +440,12 @@ class Buffer:
         return self
 
     def write_table_section(self, table_section):
-        if table_section and table_section.table_types:
-            stage = Buffer()
-            stage.write_u32(len(table_section.table_types))
-            for table_type in table_section.table_types:
-                stage.write_table_type(table_type)
-            self._write_staged_section(table_section.id, stage)
+        if table_section:
+            self.write_vec_section(
+                table_section.id,
+                table_section.table_types,
+                Buffer.write_table_type,
+            )
         return self
 
     def write_table_type(self, table_type):
@@ -462,12 +483,9 @@ class Buffer:
         raise NotImplementedError(str(type))
 
     def write_type_section(self, type_section):
-        if type_section and type_section.function_types:
-            stage = Buffer()
-            stage.write_u32(len(type_section.function_types))
-            for func_type in type_section.function_types:
-                stage.write_type(func_type)
-            self._write_staged_section(type_section.id, stage)
+        if type_section:
+            self.write_vec_section(
+                type_section.id, type_section.function_types, Buffer.write_type)
         return self
 
     def write_u32(self, value):
@@ -476,6 +494,18 @@ class Buffer:
         self._write_unsigned_integer(value)
         return self
 
+    def write_vec_section(self, section_id, items, write_item):
+        # Write a section whose contents are a vector of items, using
+        # `write_item(buffer, item)` to write each one. Empty sections are
+        # left out.
+        if items:
+            stage = Buffer()
+            stage.write_u32(len(items))
+            for item in items:
+                write_item(stage, item)
+            self._write_staged_section(section_id, stage)
+        return self
+
     def write_vec_expression(self, vec):
         self.write_u32(len(vec))
         for expr in vec:
@@ -489,10 +519,10 @@ class Buffer:
         return self
 
     def _write_staged_section(self, section_id, buffer):
-        contents = buffer.getvalue()
-        self.write_byte(section_id)
-        self.write_u32(len(contents))
-        self.write_bytes(contents)
+        with buffer.getbuffer() as contents:
+            self.write_byte(section_id)
+            self.write_u32(contents.nbytes)
+            self.write_bytes(contents)
         return self
 
     def _write_signed_integer(self, value):
@@ -502,6 +532,7 @@ class Buffer:
         continue_flag = 1 << 7
         negative_flag = 1 << 6
 
+        result = bytearray()
         rest = value
         while True:
             byte = (rest & bottom_mask)
@@ -509,23 +540,43 @@ class Buffer:
             rest = rest >> 7
             is_done = rest == (-1 if is_negative else 0)
             flag = 0 if is_done else continue_flag
-            self.write_byte(byte | flag)
+            result.append(byte | flag)
 
             if is_done:
+                self._buffer.write(result)
                 return self
 
     def _write_unsigned_integer(self, value):
         assert isinstance(value, int) and value >= 0
 
+        # Most integers in a module (indexes, counts, opcodes' immediates) fit
+        # in a single byte.
+        if value < 0x80:
+            self._buffer.write(_single_bytes[value])
+            return self
+
         bottom_mask = 0xFF >> 1
         continue_flag = 1 << 7
 
+        result = bytearray()
         rest = value
         while True:
             byte = (rest & bottom_mask)
             rest = rest >> 7
             flag = continue_flag if rest else 0
-            self.write_byte(byte | flag)
+            result.append(byte | flag)
 
             if rest == 0:
+                self._buffer.write(result)
                 return self
+
+
+_single_bytes = [bytes([i]) for i in range(256)]
+
+
+def _byte_view(value):
+    # Return a flat, unsigned-byte view of any buffer-protocol object, so that
+    # things like memoryviews, mmaps, and numpy arrays are written without
+    # first being copied into a bytes object.
+    view = memoryview(value)
+    return view if view.format == 'B' and view.ndim == 1 else view.cast('B')
@@ -1,6 +1,142 @@
+import concurrent.futures
 import itertools
 
-from . import buffer, optimizer, parser
+from . import buffer, module_optimizer, parser, reader
+from . import passes as optimization_passes
+
+
+def _instruction_table():
+    # Map each instruction's class name (like 'i32_const') and its text-format
+    # mnemonic (like 'i32.const') to a pair of (class, number of immediates).
+    prefixes = [
+        'data', 'elem', 'f32', 'f64', 'global', 'i32', 'i64', 'local',
+        'memory', 'ref', 'table',
+    ]
+    result = {}
+    for class_name in parser.Instruction.definition.split('=', 1)[1].split('|'):
+        class_name = class_name.strip()
+        cls = getattr(parser, class_name)
+        entry = (cls, len(cls._fields))
+        result[class_name] = entry
+
+        prefix, _, rest = class_name.partition('_')
+        if rest and prefix in prefixes:
+            result[f'{prefix}.{rest}'] = entry
+    return result
+
+
+def _same_items(old, new):
+    # Whether each list holds the same objects as before. The old lists keep
+    # their items alive, so a new item can't have the id of an old one.
+    return all(
+        len(a) == len(b) and all(x is y for x, y in zip(a, b))
+        for a, b in zip(old, new)
+    )
+
+
+_instructions = _instruction_table()
+
+# The module's sections, in order.
+_module_sections = [
+    'type',
+    'import',
+    'function',
+    'table',
+    'memory',
+    'global',
+    'export',
+    'start',
+    'element',
+    'data_count',
+    'code',
+    'data',
+]
+
+# The sections that are a vector of the items in one of the builder's lists,
+# along with the section id, the list, and the method that writes each item.
+_vector_sections = {
+    'type': (parser.TypeSection.id, 'function_types', buffer.Buffer.write_type),
+    'import': (parser.ImportSection.id, 'imports', buffer.Buffer.write_import),
+    'function': (
+        parser.FunctionSection.id,
+        'function_annotations',
+        buffer.Buffer.write_u32,
+    ),
+    'table': (parser.TableSection.id, 'tables', buffer.Buffer.write_table_type),
+    'memory': (
+        parser.MemorySection.id,
+        'memories',
+        buffer.Buffer.write_memory_type,
+    ),
+    'global': (parser.GlobalSection.id, 'globals', buffer.Buffer.write_global),
+    'export': (parser.ExportSection.id, 'exports', buffer.Buffer.write_export),
+    'code': (
+        parser.CodeSection.id,
+        'function_bodies',
+        buffer.Buffer.write_code_entry,
+    ),
+}
+
+# The sections that depend on each of the builder's lists.
+_list_sections = {
+    'types': ['type'],
+    'imports': ['import'],
+    'functions': ['function', 'code'],
+    'tables': ['table'],
+    'memories': ['memory'],
+    'globals': ['global'],
+    'exports': ['export'],
+    'elements': ['element'],
+    'data': [],
+}
+
+# The builder's attributes for each of its lists. After a fork, the lists are
+# shared until either builder changes them.
+_list_attributes = {
+    'types': ['function_types', 'function_types_map'],
+    'imports': ['imports'],
+    'functions': ['function_annotations', 'function_bodies'],
+    'tables': ['tables'],
+    'memories': ['memories'],
+    'globals': ['globals'],
+    'exports': ['exports'],
+    'elements': ['element_segments', 'function_element_indexes'],
+    'data': ['data_segments'],
+}
+
+# The sections that build_module keeps encoded between builds, along with the
+# builder's lists that they're encoded from. The start and data count sections
+# are tiny. The data section is not kept, since it's just a copy of the
+# segments' contents (which may be very large) and caching it would double the
+# memory that they use.
+_cached_sections = {
+    'type': ['function_types'],
+    'import': ['imports'],
+    'function': ['function_annotations'],
+    'table': ['tables'],
+    'memory': ['memories'],
+    'global': ['globals'],
+    'export': ['exports'],
+    'element': ['element_segments', 'function_element_indexes'],
+    'code': ['function_bodies'],
+}
+
+_add_function_arguments = (
+    'parameter_types',
+    'result_types',
+    'local_types',
+    'expression',
+    'export_as',
+    'add_to_table',
+    'is_start_function',
+)
+
+_add_function_defaults = {
+    'expression': None,
+    'export_as': None,
+    'add_to_table': False,
+    'is_start_function': False,
+}
 
 
 class Builder:
@@ -21,17 +157,25 @@ class Builder:
         self.globals = []
         self.exports = []
         self.start_function_index = None
+        self.function_element_offset = 0
         self.function_element_indexes = []
+        self.element_segments = []
         self.data_segments = []
 
-    def add_active_data_segment(self, offset, bytestr):
-        if not isinstance(bytestr, bytes):
-            raise TypeError(
-                'Data segment must be a bytes ojecct.'
-                f' Received: {type(bytestr)}.'
-            )
+        # Encoded sections from previous calls to build_module, by section,
+        # along with the items of the lists that they were encoded from.
+        self._encoded_sections = {}
+
+        # The lists that are shared with a fork, and must be copied before
+        # they are changed.
+        self._shared = set()
 
+    def add_active_data_segment(self, offset, bytestr):
+        offset = self.expression(offset)
+        bytestr = self._data_segment_contents(bytestr)
+        self._own('data')
         self.data_segments.append(parser.ActiveDataSegment(offset, bytestr))
+        self._touch('data')
 
     def add_block_type(self, block_type):
         if isinstance(block_type, str):
@@ -75,6 +219,9 @@ class Builder:
             add_to_table=False,
             is_start_function=False,
         ):
+        if add_to_table:
+            self._check_function_table()
+
         function_type = self.function_type(parameter_types, result_types)
         self.add_function_type(function_type)
         type_index = self.function_type_index(function_type)
@@ -92,11 +239,19 @@ class Builder:
 
         expression = self.expression(expression)
         entry = parser.CodeEntry(locals, expression)
-        function_index = len(self.function_bodies)
+        imported = self._imported_count(parser.ImportFunc)
+        function_index = imported + len(self.function_bodies)
+
+        # Check the export before adding the function.
+        export_as = self._export_as(export_as)
+        if export_as is not None:
+            self._validate_export(export_as, function_index, prefix='function_')
+
+        self._own('functions')
         self.function_annotations.append(type_index)
         self.function_bodies.append(entry)
+        self._touch('functions')
 
-        export_as = self._export_as(export_as)
         if export_as is not None:
             self.export_function(export_as, function_index)
 
@@ -111,28 +266,135 @@ class Builder:
         return (function_index, element_index)
 
     def add_function_element(self, function_index):
-        if not self.tables:
-            self.add_table('funcref', limits=[1])
-        else:
-            self.tables[0].limits[0] += 1
-
-        element_index = len(self.function_element_indexes)
+        self._grow_function_table(1)
+        self._own('elements')
+        element_index = (
+            self.function_element_offset + len(self.function_element_indexes)
+        )
         self.function_element_indexes.append(function_index)
+        self._touch('elements')
         return element_index
 
+    def add_functions(self, functions):
+        # Each function is either a dict of keyword arguments for add_function,
+        # or a tuple of its positional arguments. Types and locals are
+        # converted once per distinct signature, and nothing is added to the
+        # builder until every function has been converted and checked.
+        function_types = {}
+        type_keys = []
+        locals_runs = {}
+        bodies = []
+        table_functions = []
+        exports = []
+        export_names = {export.name for export in self.exports}
+        start_function_index = self.start_function_index
+        imported = self._imported_count(parser.ImportFunc)
+        first_index = imported + len(self.function_bodies)
+
+        for offset, spec in enumerate(functions):
+            spec = self._function_spec(spec)
+            function_index = first_index + offset
+
+            parameter_types = spec['parameter_types']
+            result_types = spec['result_types']
+            type_key = (
+                parameter_types if isinstance(parameter_types, str)
+                    else tuple(parameter_types),
+                result_types if isinstance(result_types, str)
+                    else tuple(result_types),
+            )
+            if type_key not in function_types:
+                function_type = self.function_type(parameter_types, result_types)
+                function_types[type_key] = function_type
+            type_keys.append(type_key)
+
+            locals_key = tuple(spec['local_types'])
+            if locals_key not in locals_runs:
+                runs = []
+                for t in locals_key:
+                    t = self.value_type(t)
+                    if runs and runs[-1][1] == t:
+                        runs[-1][0] += 1
+                    else:
+                        runs.append([1, t])
+                locals_runs[locals_key] = runs
+
+            locals = [
+                parser.Locals(count=count, type=t)
+                for count, t in locals_runs[locals_key]
+            ]
+            expression = spec['expression']
+            expression = self.expression([] if expression is None else expression)
+            bodies.append(parser.CodeEntry(locals, expression))
+
+            export_as = self._export_as(spec['export_as'])
+            if export_as is not None:
+                self._validate_export(
+                    export_as,
+                    function_index,
+                    prefix='function_',
+                    names=export_names,
+                )
+                export_names.add(export_as)
+                descriptor = parser.ExportFunc(function_index)
+                exports.append(parser.Export(export_as, descriptor))
+
+            if spec['is_start_function']:
+                start_function_index = function_index
+
+            if spec['add_to_table']:
+                table_functions.append(function_index)
+
+        if table_functions:
+            self._check_function_table()
+
+        type_indexes = {
+            key: self.add_function_type(function_type)
+            for key, function_type in function_types.items()
+        }
+        annotations = [type_indexes[key] for key in type_keys]
+
+        function_indexes = list(range(first_index, first_index + len(bodies)))
+        element_indexes = [None] * len(bodies)
+
+        self._own('functions', 'exports')
+        self.function_annotations.extend(annotations)
+        self.function_bodies.extend(bodies)
+        self.exports.extend(exports)
+        self.start_function_index = start_function_index
+        self._touch('functions', 'exports')
+
+        if table_functions:
+            self._grow_function_table(len(table_functions))
+            self._own('elements')
+            first_element = (
+                self.function_element_offset + len(self.function_element_indexes)
+            )
+            self.function_element_indexes.extend(table_functions)
+            self._touch('elements')
+            for offset, function_index in enumerate(table_functions):
+                element_index = first_element + offset
+                element_indexes[function_index - first_index] = element_index
+
+        return (function_indexes, element_indexes)
+
     def add_function_type(self, function_type):
         key = self._function_type_key(function_type)
         if key not in self.function_types_map:
+            self._own('types')
             self.function_types_map[key] = len(self.function_types)
             self.function_types.append(function_type)
+            self._touch('types')
 
         return self.function_types_map[key]
 
     def add_global(self, modifier, value_type, initializer, export_as=None):
         global_type = self.global_type(modifier, value_type)
         initializer = self.expression(initializer)
-        global_index = len(self.globals)
+        global_index = self._imported_count(parser.ImportGlobal) + len(self.globals)
+        self._own('globals')
         self.globals.append(parser.Global(global_type, initializer))
+        self._touch('globals')
 
         export_as = self._export_as(export_as)
         if export_as is not None:
@@ -141,8 +403,10 @@ class Builder:
         return global_index
 
     def add_memory(self, limits, export_as=None):
-        memory_index = len(self.memories)
+        memory_index = self._imported_count(parser.ImportMemory) + len(self.memories)
+        self._own('memories')
         self.memories.append(self.memory_type(limits))
+        self._touch('memories')
 
         export_as = self._export_as(export_as)
         if export_as is not None:
@@ -151,20 +415,19 @@ class Builder:
         return memory_index
 
     def add_passive_data_segment(self, bytestr):
-        if not isinstance(bytestr, bytes):
-            raise TypeError(
-                'Data segment must be a bytes ojecct.'
-                f' Received: {type(bytestr)}.'
-            )
-
+        bytestr = self._data_segment_contents(bytestr)
         result = len(self.data_segments)
+        self._own('data')
         self.data_segments.append(parser.PassiveDataSegment(bytestr))
+        self._touch('data')
         return result
 
     def add_table(self, reference_type, limits, export_as=None):
         export_as = self._export_as(export_as)
-        table_index = len(self.tables)
+        table_index = self._imported_count(parser.ImportTable) + len(self.tables)
+        self._own('tables')
         self.tables.append(self.table_type(reference_type, limits))
+        self._touch('tables')
 
         export_as = self._export_as(export_as)
         if export_as is not None:
@@ -173,31 +436,48 @@ class Builder:
         return table_index
 
     def build_module(self):
-        module = self.build_module_tree()
-        return buffer.Buffer().write_module(module).getvalue()
+        # Sections are encoded one at a time, straight from the builder's
+        # lists. Encoded sections are kept until one of the lists that they
+        # depend on changes, so rebuilding after a small edit only re-encodes
+        # the affected sections. Items that are added to, removed from or
+        # replaced in a list directly are noticed too, but changes made inside
+        # an item (like setting a code entry's expression) need invalidate.
+        result = buffer.Buffer()
+        result.write_bytes(parser.Module.magic)
+        result.write_bytes(parser.Module.version)
+        result.write_custom_sections(self.leading_custom_sections)
+
+        for section in _module_sections:
+            if section not in _cached_sections:
+                self._write_section(result, section)
+                continue
+
+            items = [list(getattr(self, a)) for a in _cached_sections[section]]
+            cached = self._encoded_sections.get(section)
+            if cached is None or not _same_items(cached[0], items):
+                stage = buffer.Buffer()
+                self._write_section(stage, section)
+                cached = (items, stage.getvalue())
+                self._encoded_sections[section] = cached
+            result.write_bytes(cached[1])
+
+        result.write_custom_sections(self.trailing_custom_sections)
+        return result.getvalue()
 
     def build_module_tree(self):
         return parser.Module(
-            type_section=parser.TypeSection(self.function_types),
-            import_section=parser.ImportSection(self.imports),
-            function_section=parser.FunctionSection(self.function_annotations),
-            table_section=parser.TableSection(self.tables),
-            memory_section=parser.MemorySection(self.memories),
-            global_section=parser.GlobalSection(self.globals),
-            export_section=parser.ExportSection(self.exports),
-            start_section=None if self.start_function_index is None
-                else parser.StartSection(self.start_function_index),
-            element_section=None if not self.function_element_indexes
-                else parser.ElementSection([
-                    parser.DefaultSegment(
-                        offset=[parser.i32_const(0)],
-                        function_indexes=self.function_element_indexes,
-                    ),
-                ]),
-            data_count_section=None if not self.data_segments
-                else parser.DataCountSection(len(self.data_segments)),
-            code_section=parser.CodeSection(self.function_bodies),
-            data_section=parser.DataSection(self.data_segments),
+            type_section=self._section_node('type'),
+            import_section=self._section_node('import'),
+            function_section=self._section_node('function'),
+            table_section=self._section_node('table'),
+            memory_section=self._section_node('memory'),
+            global_section=self._section_node('global'),
+            export_section=self._section_node('export'),
+            start_section=self._section_node('start'),
+            element_section=self._section_node('element'),
+            data_count_section=self._section_node('data_count'),
+            code_section=self._section_node('code'),
+            data_section=self._section_node('data'),
 
             # Custom sections.
             custom1=self.leading_custom_sections,
@@ -215,8 +495,26 @@ class Builder:
             custom13=self.trailing_custom_sections,
         )
 
+    def coalesce_locals(self):
+        self._run_module_pass(module_optimizer.coalesce_locals, 'functions')
+
+    def compact_data_segments(self, min_zero_run=16):
+        self._run_module_pass(
+            module_optimizer.compact_data_segments,
+            'data',
+            'functions',
+            min_zero_run=min_zero_run,
+        )
+
+    def eliminate_common_subexpressions(self):
+        self._run_module_pass(
+            module_optimizer.eliminate_common_subexpressions, 'functions',
+        )
+
     def export(self, name, descriptor):
+        self._own('exports')
         self.exports.append(parser.Export(name, descriptor))
+        self._touch('exports')
 
     def export_function(self, name, function_index):
         self._validate_export(name, function_index, prefix='function_')
@@ -237,7 +535,97 @@ class Builder:
     def expression(self, expression):
         if not isinstance(expression, list):
             expression = [expression]
-        return [self.instruction(x) for x in expression]
+
+        # Fast path for the common case: mnemonics and flat tuples whose
+        # immediates are not nested expressions. Anything else goes through
+        # the general `instruction` method.
+        result = []
+        for x in expression:
+            if isinstance(x, str):
+                entry = _instructions.get(x)
+                if entry is not None and entry[1] == 0:
+                    result.append(entry[0]())
+                    continue
+            elif isinstance(x, tuple) and x:
+                entry = _instructions.get(x[0])
+                if (
+                    entry is not None
+                    and entry[1] == len(x) - 1
+                    and not any(isinstance(arg, list) for arg in x)
+                ):
+                    result.append(entry[0](*x[1:]))
+                    continue
+            result.append(self.instruction(x))
+        return result
+
+    def fold_identical_functions(self):
+        self._run_module_pass(
+            module_optimizer.fold_identical_functions,
+            'functions',
+            'globals',
+            'exports',
+            'elements',
+        )
+
+    def fork(self):
+        # Create a builder that starts out with the same module. The two
+        # builders share their lists (and the nodes in them) until one of them
+        # changes a list, and then that builder copies the list first. The
+        # fork also starts with the encoded sections, so building it only
+        # encodes the sections that it changed. Change a fork's lists through
+        # its methods, rather than directly, so the other builder is unaffected.
+        result = type(self).__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        result.leading_custom_sections = list(self.leading_custom_sections)
+        result.trailing_custom_sections = list(self.trailing_custom_sections)
+        result._encoded_sections = dict(self._encoded_sections)
+        result._shared = set(_list_attributes)
+        self._shared = set(_list_attributes)
+        return result
+
+    @classmethod
+    def from_module(cls, module):
+        # Create a builder from a parser.Module, or from the bytes of a module.
+        # Modules read from bytes leave their function bodies undecoded until
+        # something uses them, and unchanged bodies are written back as-is.
+        if not isinstance(module, parser.Module):
+            module = reader.read_module(module)
+
+        def items(section, field):
+            return list(getattr(section, field)) if section is not None else []
+
+        builder = cls()
+        builder.function_types = items(module.type_section, 'function_types')
+        builder.function_types_map = {
+            builder._function_type_key(t): i
+            for i, t in enumerate(builder.function_types)
+        }
+        builder.imports = items(module.import_section, 'imports')
+        builder.function_annotations = items(
+            module.function_section, 'type_indexes')
+        builder.function_bodies = items(module.code_section, 'entries')
+        builder.tables = items(module.table_section, 'table_types')
+        builder.memories = items(module.memory_section, 'memory_types')
+        builder.globals = items(module.global_section, 'globals')
+        builder.exports = items(module.export_section, 'exports')
+        builder.element_segments = items(module.element_section, 'segments')
+        builder.data_segments = items(module.data_section, 'segments')
+
+        if module.start_section is not None:
+            builder.start_function_index = module.start_section.index
+
+        # Functions added to the table go after the table's current elements.
+        # (The builder can't add functions to an imported table.)
+        if builder.tables and not builder._imported_count(parser.ImportTable):
+            builder.function_element_offset = builder.tables[0].limits.min
+
+        # The builder only keeps custom sections at the start and at the end.
+        builder.leading_custom_sections = list(module.custom1 or [])
+        for slot in range(2, 14):
+            custom_sections = getattr(module, f'custom{slot}') or []
+            builder.trailing_custom_sections.extend(custom_sections)
+
+        return builder
 
     def function_type(self, parameter_types, result_types):
         if not isinstance(parameter_types, (list, str, tuple)):
@@ -283,6 +671,13 @@ class Builder:
         value_type = self.value_type(value_type)
         return parser.GlobalType(value_type, modifier)
 
+    def inline_functions(self, max_size=16):
+        self._run_module_pass(
+            module_optimizer.inline_functions,
+            'functions',
+            max_size=max_size,
+        )
+
     def instruction(self, instruction):
         if not isinstance(instruction, (list, str, tuple)):
             return instruction
@@ -298,20 +693,30 @@ class Builder:
                 f'Expected instruction to be a str. Received: {type(name)}.'
             )
 
-        class_name = name.replace('.', '_')
+        entry = _instructions.get(name)
+        if entry is None:
+            entry = _instructions.get(name.replace('.', '_'))
 
-        if not hasattr(parser, class_name):
+        if entry is None:
             raise TypeError(f'Unknown instruction: {instruction!r}.')
 
-        cls = getattr(parser, class_name)
+        cls, arity = entry
 
-        def conv(x):
-            return [self.instruction(i) for i in x] if isinstance(x, list) else x
+        if len(args) != arity:
+            raise TypeError(
+                f'Expected {arity} argument(s) for {name!r}.'
+                f' Received: {instruction!r}.'
+            )
 
-        return cls(*[conv(arg) for arg in args])
+        return cls(*[
+            self.expression(arg) if isinstance(arg, list) else arg
+            for arg in args
+        ])
 
     def import_descriptor(self, module, name, descriptor):
+        self._own('imports')
         self.imports.append(parser.Import(module, name, descriptor))
+        self._touch('imports')
 
     def import_function(self, module, name, parameter_types, result_types):
         ft = self.function_type(parameter_types, result_types)
@@ -333,6 +738,20 @@ class Builder:
         table_type = parser.TableType(reference_type, limits)
         self.import_descriptor(module, name, parser.ImportTable(table_type))
 
+    def invalidate(self, *lists):
+        # Builder methods keep track of what they change, and build_module
+        # notices items that are added to, removed from or replaced in the
+        # builder's lists. Call this after changing the nodes in a list in
+        # place, with the names of the lists, like 'functions' or 'globals'.
+        # With no names, every section is encoded again by the next
+        # build_module.
+        for name in lists:
+            if name not in _list_sections:
+                raise ValueError(
+                    f'Expected one of {list(_list_sections)!r}. Received: {name!r}.'
+                )
+        self._touch(*(lists or _list_sections))
+
     def limits(self, limits):
         if isinstance(limits, (list, tuple)):
             if len(limits) == 1:
@@ -373,9 +792,67 @@ class Builder:
     def memory_type(self, limits):
         return parser.MemoryType(self.limits(limits))
 
-    def optimize(self):
-        for entry in self.function_bodies:
-            entry.expression = optimizer.run(entry.expression)
+    def optimize(
+            self,
+            fold_functions=False,
+            inline_functions=False,
+            passes=None,
+            max_iterations=8,
+            workers=None,
+            executor=None,
+            assume_no_wrap=False,
+        ):
+        # Run a preset ('O1', 'O2' or 'Os') or a list of passes (see the passes
+        # module), and return the report. By default, this runs the peephole
+        # optimizer, along with inlining (first, so the peephole rules clean up
+        # the inlined code) and function folding if they're enabled.
+        #
+        # Function-level passes run on the executor, if there is one, or on a
+        # new process pool with the given number of workers.
+        #
+        # assume_no_wrap lets the peephole pass fold constant address additions
+        # into load and store offsets even when it can't tell that the address
+        # doesn't wrap around (see optimizer.run).
+        if passes is None:
+            passes = ['peephole']
+            if inline_functions:
+                passes.insert(0, 'inline_functions')
+            if fold_functions:
+                passes.append('fold_identical_functions')
+
+        if executor is None and workers is not None and workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                return self.optimize(
+                    passes=passes,
+                    max_iterations=max_iterations,
+                    executor=executor,
+                    assume_no_wrap=assume_no_wrap,
+                )
+
+        report = None
+
+        def run(module):
+            nonlocal report
+            report = optimization_passes.run(
+                module,
+                passes=passes,
+                max_iterations=max_iterations,
+                executor=executor,
+                assume_no_wrap=assume_no_wrap,
+            )
+
+        self._run_module_pass(run, *_list_sections)
+        return report
+
+    def propagate_constant_globals(self):
+        self._run_module_pass(
+            module_optimizer.propagate_constant_globals,
+            'functions',
+            'globals',
+            'exports',
+            'elements',
+            'data',
+        )
 
     def reference_type(self, reference_type):
         expected = self.reference_types
@@ -385,15 +862,30 @@ class Builder:
             )
         return reference_type
 
+    def remove_unused(self):
+        self._run_module_pass(
+            module_optimizer.remove_unused,
+            'types',
+            'imports',
+            'functions',
+            'globals',
+            'exports',
+            'elements',
+        )
+
     def set_function_body(self, function_index, expression):
-        if not (0 <= function_index < len(self.function_bodies)):
-            raise ValueError(
-                f'function_index out of range [0, {len(self.function_bodies)}).'
-            )
+        first = self._imported_count(parser.ImportFunc)
+        last = first + len(self.function_bodies)
+        if not (first <= function_index < last):
+            raise ValueError(f'function_index out of range [{first}, {last}).')
 
-        entry = self.function_bodies[function_index]
+        expression = self.expression(expression)
+        self._own('functions')
+        position = function_index - first
+        entry = self.function_bodies[position]
         was = entry.expression
-        entry.expression = self.expression(expression)
+        self.function_bodies[position] = entry._replace(expression=expression)
+        self._touch('functions')
         return was
 
     def table_type(self, reference_type, limits):
@@ -409,6 +901,34 @@ class Builder:
             )
         return value_type
 
+    def _check_function_table(self):
+        # Functions are added to table 0, which is the first imported table if
+        # there is one. Imported tables can't be grown here, since their size
+        # is up to the host.
+        if self._imported_count(parser.ImportTable):
+            raise ValueError(
+                'Cannot add functions to the table of a module that imports a'
+                ' table.'
+            )
+
+    def _data_segment_contents(self, contents):
+        # Accept any object that supports the buffer protocol (bytes,
+        # bytearray, memoryview, mmap, numpy arrays, ...). The object itself is
+        # stored, so large buffers are never copied before they are encoded.
+        try:
+            view = memoryview(contents)
+        except TypeError:
+            raise TypeError(
+                'Data segment must be a bytes-like object.'
+                f' Received: {type(contents)}.'
+            ) from None
+
+        with view:
+            if not view.c_contiguous:
+                raise ValueError('Data segment must be a contiguous buffer.')
+
+        return contents
+
     def _export_as(self, export_as):
         if export_as is not None and not isinstance(export_as, str):
             raise Exception(
@@ -422,7 +942,139 @@ class Builder:
         res = tuple(function_type.result_types)
         return (params, res)
 
-    def _validate_export(self, name, index, prefix=''):
+    def _function_spec(self, spec):
+        if not isinstance(spec, dict):
+            if not isinstance(spec, (list, tuple)):
+                raise TypeError(
+                    f'Expected dict, list, or tuple. Received: {type(spec)}.'
+                )
+            if len(spec) > len(_add_function_arguments):
+                raise TypeError(
+                    f'Expected at most {len(_add_function_arguments)} function'
+                    f' arguments. Received: {len(spec)}.'
+                )
+            spec = dict(zip(_add_function_arguments, spec))
+
+        unexpected = [k for k in spec if k not in _add_function_arguments]
+        if unexpected:
+            raise TypeError(f'Unexpected function arguments: {unexpected!r}.')
+
+        spec = {**_add_function_defaults, **spec}
+        missing = [k for k in _add_function_arguments if k not in spec]
+        if missing:
+            raise TypeError(f'Missing function arguments: {missing!r}.')
+
+        return spec
+
+    def _grow_function_table(self, count):
+        self._check_function_table()
+        if not self.tables:
+            self.add_table('funcref', limits=[count])
+            return
+
+        self._own('tables')
+        table = self.tables[0]
+        limits = table.limits
+        updates = {'min': limits.min + count}
+        if getattr(limits, 'max', None) is not None:
+            updates['max'] = max(limits.max, updates['min'])
+        self.tables[0] = table._replace(limits=limits._replace(**updates))
+        self._touch('tables')
+
+    def _imported_count(self, descriptor_type):
+        return sum(
+            1 for i in self.imports if isinstance(i.descriptor, descriptor_type)
+        )
+
+    def _own(self, *lists):
+        for name in lists:
+            if name in self._shared:
+                for attribute in _list_attributes[name]:
+                    setattr(self, attribute, getattr(self, attribute).copy())
+                self._shared.discard(name)
+
+    def _run_module_pass(self, function, *lists, **kwargs):
+        # Module passes update the module's lists in place, and the module tree
+        # shares most of its lists with the builder. Copy back anything else.
+        self._own(*_list_attributes)
+        module = self.build_module_tree()
+        function(module, **kwargs)
+
+        # The builder's own segment for table functions comes right after the
+        # other segments, and passes may append new segments after it.
+        if module.element_section is not None:
+            segments = module.element_section.segments
+            count = len(self.element_segments)
+            if self.function_element_indexes:
+                self.function_element_indexes[:] = segments[count].function_indexes
+                segments = segments[:count] + segments[count + 1:]
+            self.element_segments[:] = segments
+
+        start_section = module.start_section
+        self.start_function_index = (
+            None if start_section is None else start_section.index
+        )
+        self.function_types_map = {
+            self._function_type_key(t): i
+            for i, t in enumerate(self.function_types)
+        }
+        self._touch(*lists)
+
+    def _section_node(self, section):
+        if section == 'type':
+            return parser.TypeSection(self.function_types)
+
+        if section == 'import':
+            return parser.ImportSection(self.imports)
+
+        if section == 'function':
+            return parser.FunctionSection(self.function_annotations)
+
+        if section == 'table':
+            return parser.TableSection(self.tables)
+
+        if section == 'memory':
+            return parser.MemorySection(self.memories)
+
+        if section == 'global':
+            return parser.GlobalSection(self.globals)
+
+        if section == 'export':
+            return parser.ExportSection(self.exports)
+
+        if section == 'start':
+            return (None if self.start_function_index is None
+                else parser.StartSection(self.start_function_index))
+
+        if section == 'element':
+            segments = list(self.element_segments)
+            if self.function_element_indexes:
+                segments.append(parser.DefaultSegment(
+                    offset=[parser.i32_const(self.function_element_offset)],
+                    function_indexes=self.function_element_indexes,
+                ))
+            return parser.ElementSection(segments) if segments else None
+
+        if section == 'data_count':
+            return (None if not self.data_segments
+                else parser.DataCountSection(len(self.data_segments)))
+
+        if section == 'code':
+            return parser.CodeSection(self.function_bodies)
+
+        if section == 'data':
+            return parser.DataSection(self.data_segments)
+
+        raise ValueError(f'Unknown section: {section!r}.')
+
+    def _touch(self, *lists):
+        for name in lists:
+            for section in _list_sections[name]:
+                self._encoded_sections.pop(section, None)
+
+    def _validate_export(self, name, index, prefix='', names=None):
+        # Export names must be unique. By default, the name is checked against
+        # the builder's exports, or else against the given set of names.
         if not isinstance(name, str):
             raise TypeError(
                 'The name argument must be a str.'
@@ -434,3 +1086,20 @@ class Builder:
                 f'The {prefix}index argument must be an int.'
                 f' Received {type(index)}.'
             )
+
+        if names is None:
+            names = (export.name for export in self.exports)
+        if name in names:
+            raise ValueError(
+                f'Expected unique export names. Received: {name!r}.'
+            )
+
+    def _write_section(self, buf, section):
+        # Write sections that are just a vector of items straight from the
+        # builder's lists, without creating any section nodes.
+        if section in _vector_sections:
+            section_id, attribute, write_item = _vector_sections[section]
+            buf.write_vec_section(section_id, getattr(self, attribute), write_item)
+        else:
+            write = getattr(buf, f'write_{section}_section')
+            write(self._section_node(section))
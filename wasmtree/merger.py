@@ -0,0 +1,417 @@
+from . import module_optimizer, parser
+
+
+def merge(modules, exports=None):
+    # Merge several modules into one. The modules argument is a dict (or a
+    # list of pairs) that maps the name that other modules use to import from
+    # a module to either a parser.Module or a Builder. Imports that another
+    # module's exports satisfy are linked directly. The rest stay imports.
+    #
+    # The exports argument lists the names of the modules whose exports the
+    # merged module should keep. By default, it keeps all of them.
+    #
+    # Start functions run in the order of the modules. Custom sections are
+    # dropped, since their contents may refer to the old indexes.
+    if isinstance(modules, dict):
+        modules = list(modules.items())
+
+    names = [name for name, _ in modules]
+    modules = [
+        m.build_module_tree() if hasattr(m, 'build_module_tree') else m
+        for _, m in modules
+    ]
+
+    if len(set(names)) != len(names):
+        raise ValueError(f'Expected unique module names. Received: {names!r}.')
+
+    if exports is None:
+        exports = names
+
+    merger = _Merger(names, modules)
+    return merger.build(exports)
+
+
+class _Merger:
+    def __init__(self, names, modules):
+        self.modules = modules
+        self.positions = {name: i for i, name in enumerate(names)}
+
+        # The merged types, and a list mapping each module's type indexes.
+        self.types = []
+        self.type_keys = {}
+        self.type_maps = []
+        for module in modules:
+            function_types = _section_list(module.type_section, 'function_types')
+            self.type_maps.append([self._add_type(t) for t in function_types])
+
+        # Each module's imports and exports, by kind.
+        self.imports = [
+            {k: [] for k in _kinds}
+            for _ in modules
+        ]
+        for position, module in enumerate(modules):
+            for imp in _section_list(module.import_section, 'imports'):
+                kind = _import_kinds[type(imp.descriptor)]
+                self.imports[position][kind].append(imp)
+
+        self.exports = []
+        for module in modules:
+            table = {}
+            for export in _section_list(module.export_section, 'exports'):
+                kind = _export_kinds[type(export.descriptor)]
+                table[export.name] = (kind, export.descriptor.index)
+            self.exports.append(table)
+
+        # The imports that no module satisfies come first in each index space,
+        # followed by each module's definitions.
+        self.unresolved = {k: [] for k in _kinds}
+        self.unresolved_keys = {}
+        self.resolving = set()
+        self.resolved = {}
+        for position in range(len(modules)):
+            for kind in _kinds:
+                for index in range(len(self.imports[position][kind])):
+                    self._resolve_import(position, kind, index)
+
+        self.offsets = []
+        totals = {k: len(self.unresolved[k]) for k in _kinds}
+        for module in modules:
+            self.offsets.append(dict(totals))
+            for kind in _kinds:
+                totals[kind] += len(_definitions(module, kind))
+
+        if totals['memory'] > 1:
+            raise ValueError(
+                'The merged module would have more than one memory.'
+                f' Received: {totals["memory"]}.'
+            )
+
+        # Each module's element and data segments are appended in order.
+        self.element_offsets = []
+        self.data_offsets = []
+        elements = data = 0
+        for module in modules:
+            self.element_offsets.append(elements)
+            self.data_offsets.append(data)
+            elements += len(_section_list(module.element_section, 'segments'))
+            data += len(_section_list(module.data_section, 'segments'))
+
+    def build(self, export_modules):
+        positions = range(len(self.modules))
+
+        imports = []
+        for kind in _kinds:
+            for position, imp in self.unresolved[kind]:
+                imports.append(self._remap_import(position, imp))
+
+        type_indexes = []
+        code = []
+        tables = []
+        memories = []
+        globals = []
+        elements = []
+        data = []
+        for position, module in zip(positions, self.modules):
+            type_map = self.type_maps[position]
+            type_indexes.extend(
+                type_map[i]
+                for i in _section_list(module.function_section, 'type_indexes')
+            )
+            code.extend(
+                entry._replace(expression=self._remap(position, entry.expression))
+                for entry in _section_list(module.code_section, 'entries')
+            )
+            tables.extend(_section_list(module.table_section, 'table_types'))
+            memories.extend(_section_list(module.memory_section, 'memory_types'))
+            globals.extend(
+                glob._replace(initializer=self._remap(position, glob.initializer))
+                for glob in _section_list(module.global_section, 'globals')
+            )
+            elements.extend(
+                self._remap_element_segment(position, segment)
+                for segment in _section_list(module.element_section, 'segments')
+            )
+            data.extend(
+                self._remap_data_segment(position, segment)
+                for segment in _section_list(module.data_section, 'segments')
+            )
+
+        merged_exports = []
+        seen = {}
+        for name in export_modules:
+            if name not in self.positions:
+                raise ValueError(f'Unknown module: {name!r}.')
+            position = self.positions[name]
+            module = self.modules[position]
+            for export in _section_list(module.export_section, 'exports'):
+                kind = _export_kinds[type(export.descriptor)]
+                index = self._map(position, kind, export.descriptor.index)
+                if export.name in seen:
+                    if seen[export.name] != (kind, index):
+                        raise ValueError(f'Duplicate export: {export.name!r}.')
+                    continue
+                seen[export.name] = (kind, index)
+                descriptor = type(export.descriptor)(index)
+                merged_exports.append(parser.Export(export.name, descriptor))
+
+        start_functions = [
+            self._map(position, 'function', module.start_section.index)
+            for position, module in zip(positions, self.modules)
+            if module.start_section is not None
+        ]
+
+        if len(start_functions) == 1:
+            start_section = parser.StartSection(start_functions[0])
+        elif start_functions:
+            # Add a function that calls each start function in turn.
+            start_type = self._add_type(parser.FunctionType([], []))
+            start_index = len(self.unresolved['function']) + len(code)
+            type_indexes.append(start_type)
+            code.append(parser.CodeEntry(
+                locals=[],
+                expression=[parser.call(i) for i in start_functions],
+            ))
+            start_section = parser.StartSection(start_index)
+        else:
+            start_section = None
+
+        return parser.Module(
+            type_section=parser.TypeSection(self.types),
+            import_section=parser.ImportSection(imports),
+            function_section=parser.FunctionSection(type_indexes),
+            table_section=parser.TableSection(tables),
+            memory_section=parser.MemorySection(memories),
+            global_section=parser.GlobalSection(globals),
+            export_section=parser.ExportSection(merged_exports),
+            start_section=start_section,
+            element_section=parser.ElementSection(elements) if elements else None,
+            data_count_section=parser.DataCountSection(len(data)) if data else None,
+            code_section=parser.CodeSection(code),
+            data_section=parser.DataSection(data),
+
+            # Custom sections.
+            custom1=[],
+            custom2=None,
+            custom3=None,
+            custom4=None,
+            custom5=None,
+            custom6=None,
+            custom7=None,
+            custom8=None,
+            custom9=None,
+            custom10=None,
+            custom11=None,
+            custom12=None,
+            custom13=[],
+        )
+
+    def _add_type(self, function_type):
+        key = (tuple(function_type.parameter_types), tuple(function_type.result_types))
+        if key not in self.type_keys:
+            self.type_keys[key] = len(self.types)
+            self.types.append(function_type)
+        return self.type_keys[key]
+
+    def _check_import(self, position, kind, index, target, target_index):
+        imp = self.imports[position][kind][index]
+        if kind == 'function':
+            expected = self.type_maps[position][imp.descriptor.type]
+            received = self._function_type(target, target_index)
+        elif kind == 'global':
+            expected = imp.descriptor.type
+            received = self._global_type(target, target_index)
+        else:
+            return
+
+        if expected != received:
+            raise ValueError(
+                f'Import {imp.module!r}.{imp.name!r} does not match the type'
+                ' of the export.'
+            )
+
+    def _function_type(self, position, index):
+        imports = self.imports[position]['function']
+        if index < len(imports):
+            type_index = imports[index].descriptor.type
+        else:
+            type_indexes = _section_list(
+                self.modules[position].function_section, 'type_indexes')
+            type_index = type_indexes[index - len(imports)]
+        return self.type_maps[position][type_index]
+
+    def _global_type(self, position, index):
+        imports = self.imports[position]['global']
+        if index < len(imports):
+            return imports[index].descriptor.type
+        return _definitions(self.modules[position], 'global')[index - len(imports)].type
+
+    def _map(self, position, kind, index):
+        target_position, target_index = self._target(position, kind, index)
+        if target_position is None:
+            # This is one of the merged module's imports.
+            return target_index
+        return self.offsets[target_position][kind] + target_index
+
+    def _remap(self, position, expression):
+        def remap(instruction):
+            updates = {}
+            for field, kind in _instruction_fields.get(type(instruction), ()):
+                value = getattr(instruction, field)
+                if kind == 'type':
+                    if isinstance(value, int):
+                        updates[field] = self.type_maps[position][value]
+                elif kind == 'element':
+                    updates[field] = self.element_offsets[position] + value
+                elif kind == 'data':
+                    updates[field] = self.data_offsets[position] + value
+                else:
+                    updates[field] = self._map(position, kind, value)
+            return instruction._replace(**updates) if updates else instruction
+
+        return module_optimizer.map_instructions(expression, remap)
+
+    def _remap_data_segment(self, position, segment):
+        if isinstance(segment, parser.PassiveDataSegment):
+            return segment
+
+        offset = self._remap(position, segment.offset)
+        return parser.ActiveDataSegment(offset=offset, contents=segment.contents)
+
+    def _remap_element_segment(self, position, segment):
+        updates = {}
+        if hasattr(segment, 'offset'):
+            updates['offset'] = self._remap(position, segment.offset)
+        if hasattr(segment, 'function_indexes'):
+            updates['function_indexes'] = [
+                self._map(position, 'function', i) for i in segment.function_indexes
+            ]
+        if hasattr(segment, 'initializers'):
+            updates['initializers'] = [
+                self._remap(position, x) for x in segment.initializers
+            ]
+
+        table_index = getattr(segment, 'table_index', 0)
+        if isinstance(segment, (parser.DefaultSegment, parser.DefaultExpressionSegment)):
+            table_index = self._map(position, 'table', 0)
+            if table_index != 0:
+                # Segments without a table index always use table zero.
+                if isinstance(segment, parser.DefaultSegment):
+                    return parser.ActiveFuncRefSegment(
+                        table_index=table_index,
+                        offset=updates['offset'],
+                        type='funcref',
+                        function_indexes=updates['function_indexes'],
+                    )
+                return parser.ActiveExpressionSegment(
+                    table_index=table_index,
+                    offset=updates['offset'],
+                    type='funcref',
+                    initializers=updates['initializers'],
+                )
+        elif hasattr(segment, 'table_index'):
+            updates['table_index'] = self._map(position, 'table', table_index)
+
+        return segment._replace(**updates)
+
+    def _remap_import(self, position, imp):
+        descriptor = imp.descriptor
+        if isinstance(descriptor, parser.ImportFunc):
+            type_index = self.type_maps[position][descriptor.type]
+            return imp._replace(descriptor=parser.ImportFunc(type_index))
+        return imp
+
+    def _resolve_import(self, position, kind, index):
+        # Return the (position, index) of the definition that satisfies the
+        # import, or (None, index) if the merged module needs to import it.
+        key = (position, kind, index)
+        if key in self.resolved:
+            return self.resolved[key]
+
+        imp = self.imports[position][kind][index]
+        target = self.positions.get(imp.module)
+        export = None if target is None else self.exports[target].get(imp.name)
+
+        if export is None or export[0] != kind:
+            # Nothing satisfies this import, so it stays an import. Identical
+            # imports from several modules are merged.
+            descriptor = imp.descriptor
+            if isinstance(descriptor, parser.ImportFunc):
+                descriptor = self.type_maps[position][descriptor.type]
+            unresolved_key = (imp.module, imp.name, kind, descriptor)
+            if unresolved_key not in self.unresolved_keys:
+                self.unresolved_keys[unresolved_key] = len(self.unresolved[kind])
+                self.unresolved[kind].append((position, imp))
+            result = (None, self.unresolved_keys[unresolved_key])
+        else:
+            if key in self.resolving:
+                raise ValueError(
+                    f'Circular import: {imp.module!r}.{imp.name!r}.'
+                )
+            self.resolving.add(key)
+            self._check_import(position, kind, index, target, export[1])
+            result = self._target(target, kind, export[1])
+            self.resolving.discard(key)
+
+        self.resolved[key] = result
+        return result
+
+    def _target(self, position, kind, index):
+        imports = self.imports[position][kind]
+        if index < len(imports):
+            return self._resolve_import(position, kind, index)
+        return (position, index - len(imports))
+
+
+def _definitions(module, kind):
+    if kind == 'function':
+        return _section_list(module.function_section, 'type_indexes')
+    if kind == 'table':
+        return _section_list(module.table_section, 'table_types')
+    if kind == 'memory':
+        return _section_list(module.memory_section, 'memory_types')
+    if kind == 'global':
+        return _section_list(module.global_section, 'globals')
+    raise ValueError(f'Unknown kind: {kind!r}.')
+
+
+def _section_list(section, field):
+    return getattr(section, field) if section is not None else []
+
+
+_kinds = ['function', 'table', 'memory', 'global']
+
+_import_kinds = {
+    parser.ImportFunc: 'function',
+    parser.ImportTable: 'table',
+    parser.ImportMemory: 'memory',
+    parser.ImportGlobal: 'global',
+}
+
+_export_kinds = {
+    parser.ExportFunc: 'function',
+    parser.ExportTable: 'table',
+    parser.ExportMemory: 'memory',
+    parser.ExportGlobal: 'global',
+}
+
+# The fields of each instruction that hold an index, and the kind of index.
+_instruction_fields = {
+    parser.Block: [('type', 'type')],
+    parser.Loop: [('type', 'type')],
+    parser.If: [('type', 'type')],
+    parser.call: [('function', 'function')],
+    parser.call_indirect: [('type_index', 'type'), ('table_index', 'table')],
+    parser.ref_func: [('function', 'function')],
+    parser.global_get: [('index', 'global')],
+    parser.global_set: [('index', 'global')],
+    parser.table_get: [('index', 'table')],
+    parser.table_set: [('index', 'table')],
+    parser.memory_init: [('data_index', 'data')],
+    parser.data_drop: [('data_index', 'data')],
+    parser.table_init: [('element', 'element'), ('table', 'table')],
+    parser.elem_drop: [('element', 'element')],
+    parser.table_copy: [('destination', 'table'), ('source', 'table')],
+    parser.table_grow: [('table', 'table')],
+    parser.table_size: [('table', 'table')],
+    parser.table_fill: [('table', 'table')],
+}
@@ -0,0 +1,1057 @@
+import bisect
+import heapq
+import re
+
+from . import buffer, optimizer, parser
+
+
+# Module-level passes work on a parser.Module in place. They update the
+# module's lists (which may be shared with a Builder), but they never change
+# any other node that they didn't create. Instead, they replace it.
+
+
+def coalesce_locals(module):
+    # Give locals whose live ranges don't overlap the same slot, remove locals
+    # that are never read, and sort the remaining locals by type. Parameters
+    # are left alone.
+    entries = _code_entries(module)
+    type_indexes = _function_type_indexes(module)
+    section = module.type_section
+    function_types = section.function_types if section is not None else []
+
+    for position, entry in enumerate(entries):
+        if not entry.locals:
+            continue
+        function_type = function_types[type_indexes[position]]
+        parameter_count = len(function_type.parameter_types)
+        entries[position] = _coalesce_entry_locals(entry, parameter_count)
+
+    return module
+
+
+def compact_data_segments(module, min_zero_run=16):
+    segments = _data_segments(module)
+    if not segments:
+        return module
+
+    # Find the segments that the code refers to, with memory.init or data.drop.
+    referenced = set()
+    dropped = set()
+    for entry in _code_entries(module):
+        for instruction in iter_instructions(entry.expression):
+            if isinstance(instruction, (parser.memory_init, parser.data_drop)):
+                referenced.add(instruction.data_index)
+            if isinstance(instruction, parser.data_drop):
+                dropped.add(instruction.data_index)
+
+    # Work out which active segments can be rearranged. Linear memory is only
+    # known to start out zeroed if the module defines it (rather than importing
+    # it). The segments must not overlap, since then their order matters. And
+    # they must fit in the memory, since otherwise instantiation traps, and
+    # trimming their zeros could stop it from trapping.
+    active = {}
+    memory_size = _memory_size(module)
+    movable = not _imports_memory(module) and memory_size is not None
+    for index, segment in enumerate(segments):
+        if not isinstance(segment, _active_data_segments):
+            continue
+        if getattr(segment, 'index', 0) != 0:
+            continue
+        offset = _constant_offset(segment.offset)
+        if offset is None or index in referenced:
+            movable = False
+            break
+        active[index] = (offset, bytes(segment.contents))
+
+    if movable and _overlaps(active.values()):
+        movable = False
+
+    if movable and any(
+        offset + len(contents) > memory_size
+        for offset, contents in active.values()
+    ):
+        movable = False
+
+    if not movable:
+        active = {}
+
+    # Build the new list of segments. The compacted active segments take the
+    # place of the first active segment.
+    result = []
+    old_to_new = {}
+    passive_contents = {}
+    first_active = min(active) if active else None
+
+    for index, segment in enumerate(segments):
+        if index in active:
+            if index == first_active:
+                compacted = _compact_active_segments(active.values(), min_zero_run)
+                result.extend(compacted)
+            continue
+
+        if isinstance(segment, parser.PassiveDataSegment) and index not in dropped:
+            # Reuse an identical passive segment, unless the code drops it.
+            key = bytes(segment.contents)
+            if key in passive_contents:
+                old_to_new[index] = passive_contents[key]
+                continue
+            passive_contents[key] = len(result)
+
+        old_to_new[index] = len(result)
+        result.append(segment)
+
+    if len(result) == len(segments) and all(
+        a is b for a, b in zip(result, segments)
+    ):
+        return module
+
+    segments[:] = result
+
+    if module.data_count_section is not None:
+        module.data_count_section = parser.DataCountSection(len(segments))
+
+    def remap(instruction):
+        if isinstance(instruction, (parser.memory_init, parser.data_drop)):
+            index = old_to_new[instruction.data_index]
+            if index != instruction.data_index:
+                return instruction._replace(data_index=index)
+        return instruction
+
+    _map_code(module, remap)
+    return module
+
+
+def eliminate_common_subexpressions(module):
+    # Save repeated computations (like the address of a field that is read
+    # several times) in new locals, using
+    # optimizer.eliminate_common_subexpressions on each function.
+    entries = _code_entries(module)
+    type_indexes = _function_type_indexes(module)
+    section = module.type_section
+    function_types = section.function_types if section is not None else []
+
+    for position, entry in enumerate(entries):
+        function_type = function_types[type_indexes[position]]
+        local_count = len(function_type.parameter_types) + sum(
+            run.count for run in entry.locals
+        )
+        expression, local_types = optimizer.eliminate_common_subexpressions(
+            entry.expression, local_count,
+        )
+        if not local_types:
+            continue
+
+        locals = list(entry.locals)
+        for t in local_types:
+            if locals and locals[-1].type == t:
+                locals[-1] = parser.Locals(count=locals[-1].count + 1, type=t)
+            else:
+                locals.append(parser.Locals(count=1, type=t))
+        entries[position] = entry._replace(locals=locals, expression=expression)
+
+    return module
+
+
+def fold_identical_functions(module):
+    # Keep one copy of each group of functions that have the same type and the
+    # same encoded body, and point every reference at it. Folding functions
+    # can make their callers identical, so repeat until nothing changes.
+    # (Function names in custom sections are not updated.)
+    while True:
+        entries = _code_entries(module)
+        type_indexes = _function_type_indexes(module)
+        imported = _imported_function_count(module)
+
+        canonical = {}
+        replacements = {}
+        keep = []
+        for position, entry in enumerate(entries):
+            index = imported + position
+            body = buffer.Buffer().write_code_entry(entry).getvalue()
+            key = (type_indexes[position], body)
+            if key in canonical:
+                replacements[index] = canonical[key]
+            else:
+                canonical[key] = index
+                keep.append(position)
+
+        if not replacements:
+            return module
+
+        renumbered = {imported + p: imported + n for n, p in enumerate(keep)}
+        old_to_new = {
+            index: renumbered[replacements.get(index, index)]
+            for index in range(imported, imported + len(entries))
+        }
+        _keep_functions(module, keep)
+        _remap_functions(module, old_to_new)
+
+
+def inline_functions(module, max_size=16):
+    # Replace calls to small functions (with at most max_size instructions)
+    # with a block that runs the function's body. The arguments are moved into
+    # new locals in the caller, and so are the callee's own locals, which are
+    # set to zero first. Functions that are part of a cycle of calls are never
+    # inlined, and neither are functions with more than one result.
+    entries = _code_entries(module)
+    type_indexes = _function_type_indexes(module)
+    section = module.type_section
+    function_types = section.function_types if section is not None else []
+    imported = _imported_function_count(module)
+
+    # Find the functions that each function calls.
+    callees = []
+    callers = [set() for _ in entries]
+    for position, entry in enumerate(entries):
+        called = {
+            instruction.function - imported
+            for instruction in iter_instructions(entry.expression)
+            if isinstance(instruction, parser.call)
+            and instruction.function >= imported
+        }
+        callees.append(called)
+        for callee in called:
+            callers[callee].add(position)
+
+    def inline_calls(position):
+        # Inline any calls to the functions that are already done.
+        entry = entries[position]
+        function_type = function_types[type_indexes[position]]
+        local_count = len(function_type.parameter_types) + sum(
+            run.count for run in entry.locals
+        )
+        new_locals = []
+
+        def inline(instruction):
+            nonlocal local_count
+            callee = instruction.function - imported
+            if callee not in inlinable:
+                return None
+
+            callee_entry = entries[callee]
+            callee_type = function_types[type_indexes[callee]]
+            parameter_types = list(callee_type.parameter_types)
+            local_types = parameter_types + [
+                run.type for run in callee_entry.locals for _ in range(run.count)
+            ]
+            base = local_count
+            local_count += len(local_types)
+            new_locals.extend(local_types)
+
+            result = [
+                parser.local_set(base + i)
+                for i in reversed(range(len(parameter_types)))
+            ]
+            for i, t in enumerate(local_types[len(parameter_types):]):
+                result.append(_zero_constant(t))
+                result.append(parser.local_set(base + len(parameter_types) + i))
+
+            result_types = callee_type.result_types
+            block_type = result_types[0] if result_types else 'empty'
+            body = _inline_body(callee_entry.expression, base, 0)
+            result.append(parser.Block(block_type, body))
+            return result
+
+        expression = _expand_calls(entry.expression, inline)
+        if expression is not entry.expression:
+            locals = list(entry.locals)
+            for t in new_locals:
+                if locals and locals[-1].type == t:
+                    locals[-1] = locals[-1]._replace(count=locals[-1].count + 1)
+                else:
+                    locals.append(parser.Locals(count=1, type=t))
+            entries[position] = entry._replace(
+                locals=locals,
+                expression=expression,
+            )
+
+    # Work from the callees up to their callers, so a function's body is final
+    # before it's inlined anywhere. Functions that (directly or indirectly)
+    # call themselves are never done, so they're never inlined.
+    inlinable = set()
+    remaining = [len(c) - (p in c) for p, c in enumerate(callees)]
+    ready = [p for p, c in enumerate(callees) if not c]
+    done = set()
+    while ready:
+        position = ready.pop()
+        done.add(position)
+        inline_calls(position)
+
+        entry = entries[position]
+        function_type = function_types[type_indexes[position]]
+        size = sum(1 for _ in iter_instructions(entry.expression))
+        if (
+            size <= max_size
+            and len(function_type.result_types) <= 1
+            and position not in callees[position]
+        ):
+            inlinable.add(position)
+
+        for caller in callers[position]:
+            if caller != position:
+                remaining[caller] -= 1
+                if remaining[caller] == 0:
+                    ready.append(caller)
+
+    for position in range(len(entries)):
+        if position not in done:
+            inline_calls(position)
+
+    return module
+
+
+def iter_instructions(expression):
+    for instruction in expression:
+        yield instruction
+        for body in _nested_bodies(instruction):
+            yield from iter_instructions(body)
+
+
+def map_instructions(expression, function):
+    # Apply the function to every instruction in the expression, including the
+    # instructions in nested blocks. Returns the original list if the function
+    # didn't replace any instructions.
+    result = []
+    changed = False
+
+    for instruction in expression:
+        updates = {}
+        for field in _nested_fields.get(type(instruction), ()):
+            body = getattr(instruction, field)
+            if body is not None:
+                new_body = map_instructions(body, function)
+                if new_body is not body:
+                    updates[field] = new_body
+
+        new_instruction = instruction._replace(**updates) if updates else instruction
+        new_instruction = function(new_instruction)
+        changed = changed or new_instruction is not instruction
+        result.append(new_instruction)
+
+    return result if changed else expression
+
+
+def propagate_constant_globals(module):
+    # Replace every global.get of an immutable global that is initialized with
+    # a constant by the constant itself, and then remove the globals that are
+    # no longer used or exported. Imported globals are left alone, since their
+    # values are only known when the module is instantiated.
+    globals = _globals(module)
+    imported = sum(
+        1 for i in _imports(module) if isinstance(i.descriptor, parser.ImportGlobal)
+    )
+    constant_classes = tuple(_constants.values())
+
+    # A global can be initialized with another one, which only becomes a
+    # constant once the other one is replaced, so repeat until nothing new is
+    # found.
+    constants = {}
+    while True:
+        found = {}
+        for index, glob in enumerate(globals, imported):
+            if (
+                index not in constants
+                and glob.type.modifier == 'const'
+                and len(glob.initializer) == 1
+                and isinstance(glob.initializer[0], constant_classes)
+            ):
+                found[index] = glob.initializer[0]
+        if not found:
+            break
+        constants.update(found)
+
+        def replace(instruction):
+            if isinstance(instruction, parser.global_get):
+                return found.get(instruction.index, instruction)
+            return instruction
+
+        _map_code(module, replace)
+        _map_constant_expressions(module, replace)
+
+    if not constants:
+        return module
+
+    # Find the globals that are still used.
+    used = set()
+    for export in _exports(module):
+        if isinstance(export.descriptor, parser.ExportGlobal):
+            used.add(export.descriptor.index)
+
+    def use(instruction):
+        if isinstance(instruction, (parser.global_get, parser.global_set)):
+            used.add(instruction.index)
+        return instruction
+
+    _map_code(module, use)
+    _map_constant_expressions(module, use)
+
+    removed = {index for index in constants if index not in used}
+    if removed:
+        old_to_new = {}
+        kept = []
+        for position, glob in enumerate(globals):
+            index = imported + position
+            if index not in removed:
+                old_to_new[index] = imported + len(kept)
+                kept.append(glob)
+        globals[:] = kept
+        _remap_globals(module, old_to_new)
+
+    return module
+
+
+def remove_unused(module):
+    # Remove the functions and globals (defined or imported) that can't be
+    # reached from the exports, the start function, or the element and data
+    # segments, and then remove the function types that are no longer used.
+    # Every reference to a function, global, or type is renumbered. (Function
+    # names in custom sections are not updated.)
+    imports = _imports(module)
+    entries = _code_entries(module)
+    globals = _globals(module)
+    imported_functions = _imported_function_count(module)
+    imported_globals = sum(
+        1 for i in imports if isinstance(i.descriptor, parser.ImportGlobal)
+    )
+
+    live_functions = set()
+    live_globals = set()
+    pending = []
+
+    def use(instruction):
+        if isinstance(instruction, (parser.call, parser.ref_func)):
+            use_function(instruction.function)
+        elif isinstance(instruction, (parser.global_get, parser.global_set)):
+            use_global(instruction.index)
+
+    def use_function(index):
+        if index not in live_functions:
+            live_functions.add(index)
+            if index >= imported_functions:
+                pending.append(index)
+
+    def use_global(index):
+        if index not in live_globals:
+            live_globals.add(index)
+            if index >= imported_globals:
+                glob = globals[index - imported_globals]
+                for instruction in iter_instructions(glob.initializer):
+                    use(instruction)
+
+    for export in _exports(module):
+        descriptor = export.descriptor
+        if isinstance(descriptor, parser.ExportFunc):
+            use_function(descriptor.index)
+        elif isinstance(descriptor, parser.ExportGlobal):
+            use_global(descriptor.index)
+
+    if module.start_section is not None:
+        use_function(module.start_section.index)
+
+    for segment in _element_segments(module) + _data_segments(module):
+        for index in getattr(segment, 'function_indexes', None) or []:
+            use_function(index)
+        expressions = list(getattr(segment, 'initializers', None) or [])
+        if getattr(segment, 'offset', None) is not None:
+            expressions.append(segment.offset)
+        for expression in expressions:
+            for instruction in iter_instructions(expression):
+                use(instruction)
+
+    while pending:
+        entry = entries[pending.pop() - imported_functions]
+        for instruction in iter_instructions(entry.expression):
+            use(instruction)
+
+    # Number the live functions and globals, imports first.
+    function_map = {}
+    global_map = {}
+    kept_imports = []
+    function_index = global_index = 0
+    for item in imports:
+        descriptor = item.descriptor
+        if isinstance(descriptor, parser.ImportFunc):
+            function_index += 1
+            if function_index - 1 not in live_functions:
+                continue
+            function_map[function_index - 1] = len(function_map)
+        elif isinstance(descriptor, parser.ImportGlobal):
+            global_index += 1
+            if global_index - 1 not in live_globals:
+                continue
+            global_map[global_index - 1] = len(global_map)
+        kept_imports.append(item)
+
+    kept_functions = []
+    for position in range(len(entries)):
+        if imported_functions + position in live_functions:
+            function_map[imported_functions + position] = len(function_map)
+            kept_functions.append(position)
+
+    kept_globals = []
+    for position, glob in enumerate(globals):
+        if imported_globals + position in live_globals:
+            global_map[imported_globals + position] = len(global_map)
+            kept_globals.append(glob)
+
+    # A function used by ref.func in code must also be named outside of the
+    # code, like in an export or an element segment. If a removed global was
+    # the only place that named it, declare it with a declarative segment.
+    referenced = set()
+    for position in kept_functions:
+        for instruction in iter_instructions(entries[position].expression):
+            if isinstance(instruction, parser.ref_func):
+                referenced.add(instruction.function)
+    if referenced:
+        declared = _declared_functions(module, kept_globals)
+        undeclared = sorted(referenced - declared)
+        if undeclared:
+            segment = parser.DeclarativeFuncRefSegment('funcref', undeclared)
+            if module.element_section is None:
+                module.element_section = parser.ElementSection([segment])
+            else:
+                module.element_section.segments.append(segment)
+
+    if len(kept_imports) != len(imports):
+        imports[:] = kept_imports
+    if len(kept_functions) != len(entries):
+        _keep_functions(module, kept_functions)
+    if len(kept_globals) != len(globals):
+        globals[:] = kept_globals
+    _remap_functions(module, function_map)
+    _remap_globals(module, global_map)
+
+    # Now remove the unused types.
+    used_types = set(_function_type_indexes(module))
+    for item in imports:
+        if isinstance(item.descriptor, parser.ImportFunc):
+            used_types.add(item.descriptor.type)
+    for entry in entries:
+        for instruction in iter_instructions(entry.expression):
+            if isinstance(instruction, parser.call_indirect):
+                used_types.add(instruction.type_index)
+            elif isinstance(instruction, _block_instructions):
+                if isinstance(instruction.type, int):
+                    used_types.add(instruction.type)
+
+    section = module.type_section
+    types = section.function_types if section is not None else []
+    if len(used_types) != len(types):
+        kept_types = sorted(used_types)
+        types[:] = [types[i] for i in kept_types]
+        _remap_types(module, {old: new for new, old in enumerate(kept_types)})
+
+    return module
+
+
+def _coalesce_entry_locals(entry, parameter_count):
+    local_types = [
+        run.type for run in entry.locals for _ in range(run.count)
+    ]
+    accesses, loops, body_ends = _local_accesses(entry.expression)
+
+    # The positions of each local's accesses, and the locals that are read.
+    positions = {}
+    local_accesses = {}
+    read = set()
+    for access in accesses:
+        position, index, is_write, _ = access
+        if index < parameter_count:
+            continue
+        positions.setdefault(index, []).append(position)
+        local_accesses.setdefault(index, []).append(access)
+        if not is_write:
+            read.add(index)
+
+    def self_contained(accesses):
+        # Whether the first access is a write that comes before every other
+        # access in the same block. If so, the local's earlier value is never
+        # read.
+        _, _, is_write, body = accesses[0]
+        return is_write and accesses[-1][0] <= body_ends[body]
+
+    # Find each local's live range. A local that may be read before it's
+    # written reads its initial zero, so it can't reuse an earlier slot.
+    ranges = {}
+    for index in read:
+        start, end = positions[index][0], positions[index][-1]
+        if not self_contained(local_accesses[index]):
+            start = -1
+        ranges[index] = [start, end]
+
+    # A local's value may also be carried around a loop. Unless the local is
+    # only used within one iteration, it's live for the whole loop.
+    changed = True
+    while changed:
+        changed = False
+        for loop_start, loop_end in loops:
+            for index, live in ranges.items():
+                if live[1] < loop_start or live[0] > loop_end:
+                    continue
+                if live[0] <= loop_start and live[1] >= loop_end:
+                    continue
+                if loop_start < live[0] and live[1] <= loop_end:
+                    first = bisect.bisect_left(positions[index], loop_start)
+                    last = bisect.bisect_right(positions[index], loop_end)
+                    if self_contained(local_accesses[index][first:last]):
+                        continue
+                live[0] = min(live[0], loop_start)
+                live[1] = max(live[1], loop_end)
+                changed = True
+
+    # Assign slots for each type, reusing the slots of finished live ranges.
+    type_order = list(dict.fromkeys(local_types))
+    slots = {t: [] for t in type_order}
+    slot_counts = {t: 0 for t in type_order}
+    assigned = {}
+    for index in sorted(ranges, key=lambda i: ranges[i]):
+        t = local_types[index - parameter_count]
+        start, end = ranges[index]
+        if slots[t] and slots[t][0][0] < start:
+            _, slot = heapq.heappop(slots[t])
+        else:
+            slot = slot_counts[t]
+            slot_counts[t] += 1
+        heapq.heappush(slots[t], (end, slot))
+        assigned[index] = (t, slot)
+
+    first_slot = {}
+    locals = []
+    for t in type_order:
+        if slot_counts[t]:
+            first_slot[t] = parameter_count + sum(r.count for r in locals)
+            locals.append(parser.Locals(count=slot_counts[t], type=t))
+
+    new_indexes = {
+        index: first_slot[t] + slot for index, (t, slot) in assigned.items()
+    }
+    unread = set(positions) - read
+
+    if (
+        not unread
+        and locals == entry.locals
+        and all(index == new for index, new in new_indexes.items())
+    ):
+        return entry
+
+    expression = _rewrite_locals(entry.expression, new_indexes, unread)
+    return entry._replace(locals=locals, expression=expression)
+
+
+def _code_entries(module):
+    section = module.code_section
+    return section.entries if section is not None else []
+
+
+def _compact_active_segments(active, min_zero_run):
+    # Merge adjacent segments, then split the merged contents around long runs
+    # of zeros, and drop any leading and trailing zeros.
+    merged = []
+    for offset, contents in sorted(active):
+        if merged and merged[-1][0] + len(merged[-1][1]) == offset:
+            merged[-1][1].extend(contents)
+        else:
+            merged.append((offset, bytearray(contents)))
+
+    zero_run = re.compile(b'\\x00{%d,}' % max(min_zero_run, 1))
+    result = []
+    for offset, contents in merged:
+        pieces = []
+        start = 0
+        for match in zero_run.finditer(contents):
+            pieces.append((start, match.start()))
+            start = match.end()
+        pieces.append((start, len(contents)))
+
+        for start, end in pieces:
+            chunk = bytes(contents[start:end])
+            stripped = chunk.lstrip(b'\x00')
+            start += len(chunk) - len(stripped)
+            stripped = stripped.rstrip(b'\x00')
+            if stripped:
+                result.append(parser.ActiveDataSegment(
+                    offset=[parser.i32_const(_to_signed_i32(offset + start))],
+                    contents=stripped,
+                ))
+
+    return result
+
+
+def _constant_offset(expression):
+    if len(expression) == 1 and isinstance(expression[0], parser.i32_const):
+        return expression[0].number & 0xFFFFFFFF
+    return None
+
+
+def _data_segments(module):
+    section = module.data_section
+    return section.segments if section is not None else []
+
+
+def _declared_functions(module, globals):
+    # The functions that are named outside of the code (and the start
+    # section), so that ref.func can use them.
+    result = set()
+    for export in _exports(module):
+        if isinstance(export.descriptor, parser.ExportFunc):
+            result.add(export.descriptor.index)
+
+    expressions = [glob.initializer for glob in globals]
+    for segment in _element_segments(module):
+        result.update(getattr(segment, 'function_indexes', None) or [])
+        expressions.extend(getattr(segment, 'initializers', None) or [])
+    for expression in expressions:
+        for instruction in iter_instructions(expression):
+            if isinstance(instruction, parser.ref_func):
+                result.add(instruction.function)
+    return result
+
+
+def _element_segments(module):
+    section = module.element_section
+    return section.segments if section is not None else []
+
+
+def _exports(module):
+    section = module.export_section
+    return section.exports if section is not None else []
+
+
+def _expand_calls(expression, function):
+    # Replace each call with the list of instructions that the function
+    # returns for it, unless it returns None.
+    result = []
+    changed = False
+    for instruction in expression:
+        if isinstance(instruction, parser.call):
+            replacement = function(instruction)
+            if replacement is not None:
+                result.extend(replacement)
+                changed = True
+                continue
+        else:
+            updates = {}
+            for field in _nested_fields.get(type(instruction), ()):
+                body = getattr(instruction, field)
+                if body is not None:
+                    new_body = _expand_calls(body, function)
+                    if new_body is not body:
+                        updates[field] = new_body
+            if updates:
+                instruction = instruction._replace(**updates)
+                changed = True
+        result.append(instruction)
+    return result if changed else expression
+
+
+def _function_type_indexes(module):
+    section = module.function_section
+    return section.type_indexes if section is not None else []
+
+
+def _globals(module):
+    section = module.global_section
+    return section.globals if section is not None else []
+
+
+def _imported_function_count(module):
+    imports = _imports(module)
+    return sum(1 for i in imports if isinstance(i.descriptor, parser.ImportFunc))
+
+
+def _imports(module):
+    section = module.import_section
+    return section.imports if section is not None else []
+
+
+def _imports_memory(module):
+    imports = _imports(module)
+    return any(isinstance(i.descriptor, parser.ImportMemory) for i in imports)
+
+
+def _inline_body(expression, local_base, depth):
+    # Move the function body's locals to start at local_base, and turn each
+    # return into a branch out of the block that replaces the call. Other
+    # branches don't change, since the block takes the place of the function.
+    result = []
+    for instruction in expression:
+        if isinstance(instruction, _local_instructions):
+            instruction = instruction._replace(index=local_base + instruction.index)
+        elif isinstance(instruction, parser.ret):
+            instruction = parser.br(depth)
+        else:
+            updates = {}
+            for field in _nested_fields.get(type(instruction), ()):
+                body = getattr(instruction, field)
+                if body is not None:
+                    updates[field] = _inline_body(body, local_base, depth + 1)
+            if updates:
+                instruction = instruction._replace(**updates)
+        result.append(instruction)
+    return result
+
+
+def _keep_functions(module, positions):
+    # Keep only the defined functions at the given positions.
+    entries = _code_entries(module)
+    entries[:] = [entries[p] for p in positions]
+    type_indexes = _function_type_indexes(module)
+    type_indexes[:] = [type_indexes[p] for p in positions]
+
+
+def _local_accesses(expression):
+    # Number the instructions in order, including nested instructions, and
+    # return every local access as (position, local index, is write, body),
+    # the range of positions in each loop, and the last position in each
+    # body. (Body 0 is the whole expression.)
+    accesses = []
+    loops = []
+    body_ends = [None]
+    position = 0
+
+    def walk(expression, body):
+        nonlocal position
+        for instruction in expression:
+            start = position
+            position += 1
+            if isinstance(instruction, parser.local_get):
+                accesses.append((start, instruction.index, False, body))
+            elif isinstance(instruction, (parser.local_set, parser.local_tee)):
+                accesses.append((start, instruction.index, True, body))
+
+            for nested in _nested_bodies(instruction):
+                nested_body = len(body_ends)
+                body_ends.append(None)
+                walk(nested, nested_body)
+                body_ends[nested_body] = position - 1
+
+            if isinstance(instruction, parser.Loop):
+                loops.append((start, position - 1))
+
+    walk(expression, 0)
+    body_ends[0] = position - 1
+    return accesses, loops, body_ends
+
+
+def _map_code(module, function):
+    entries = _code_entries(module)
+    for index, entry in enumerate(entries):
+        expression = map_instructions(entry.expression, function)
+        if expression is not entry.expression:
+            entries[index] = entry._replace(expression=expression)
+
+
+def _map_constant_expressions(module, function):
+    # Apply the function to the instructions in global initializers, segment
+    # offsets, and element initializers.
+    if module.global_section is not None:
+        globals = module.global_section.globals
+        for position, glob in enumerate(globals):
+            initializer = map_instructions(glob.initializer, function)
+            if initializer is not glob.initializer:
+                globals[position] = glob._replace(initializer=initializer)
+
+    for section, field in [
+        (module.element_section, 'segments'),
+        (module.data_section, 'segments'),
+    ]:
+        segments = getattr(section, field) if section is not None else []
+        for position, segment in enumerate(segments):
+            updates = {}
+            offset = getattr(segment, 'offset', None)
+            if offset is not None:
+                new_offset = map_instructions(offset, function)
+                if new_offset is not offset:
+                    updates['offset'] = new_offset
+
+            initializers = getattr(segment, 'initializers', None)
+            if initializers is not None:
+                new_initializers = [
+                    map_instructions(x, function) for x in initializers
+                ]
+                if any(a is not b for a, b in zip(new_initializers, initializers)):
+                    updates['initializers'] = new_initializers
+
+            if updates:
+                segments[position] = segment._replace(**updates)
+
+
+def _memory_size(module):
+    # The initial size of the module's first defined memory, in bytes.
+    section = module.memory_section
+    if section is None or not section.memory_types:
+        return None
+    return section.memory_types[0].limits.min * 65536
+
+
+def _nested_bodies(instruction):
+    for field in _nested_fields.get(type(instruction), ()):
+        body = getattr(instruction, field)
+        if body is not None:
+            yield body
+
+
+def _overlaps(active):
+    end = None
+    for offset, contents in sorted(active):
+        if end is not None and offset < end:
+            return True
+        end = max(end or 0, offset + len(contents))
+    return False
+
+
+def _remap_functions(module, old_to_new):
+    # Update every reference to a function index, using the old_to_new dict.
+    # Indexes that are not in the dict are left alone.
+    if not any(old != new for old, new in old_to_new.items()):
+        return
+
+    def remap(instruction):
+        if isinstance(instruction, (parser.call, parser.ref_func)):
+            index = old_to_new.get(instruction.function, instruction.function)
+            if index != instruction.function:
+                return instruction._replace(function=index)
+        return instruction
+
+    _map_code(module, remap)
+    _map_constant_expressions(module, remap)
+
+    if module.export_section is not None:
+        exports = module.export_section.exports
+        for position, export in enumerate(exports):
+            descriptor = export.descriptor
+            if isinstance(descriptor, parser.ExportFunc):
+                index = old_to_new.get(descriptor.index, descriptor.index)
+                if index != descriptor.index:
+                    exports[position] = export._replace(
+                        descriptor=parser.ExportFunc(index),
+                    )
+
+    if module.start_section is not None:
+        index = module.start_section.index
+        module.start_section = parser.StartSection(old_to_new.get(index, index))
+
+    if module.element_section is not None:
+        segments = module.element_section.segments
+        for position, segment in enumerate(segments):
+            function_indexes = getattr(segment, 'function_indexes', None)
+            if function_indexes is not None:
+                segments[position] = segment._replace(function_indexes=[
+                    old_to_new.get(i, i) for i in function_indexes
+                ])
+
+
+def _remap_globals(module, old_to_new):
+    # Update every reference to a global index, like _remap_functions.
+    if not any(old != new for old, new in old_to_new.items()):
+        return
+
+    def remap(instruction):
+        if isinstance(instruction, (parser.global_get, parser.global_set)):
+            index = old_to_new.get(instruction.index, instruction.index)
+            if index != instruction.index:
+                return instruction._replace(index=index)
+        return instruction
+
+    _map_code(module, remap)
+    _map_constant_expressions(module, remap)
+
+    exports = _exports(module)
+    for position, export in enumerate(exports):
+        descriptor = export.descriptor
+        if isinstance(descriptor, parser.ExportGlobal):
+            index = old_to_new.get(descriptor.index, descriptor.index)
+            if index != descriptor.index:
+                exports[position] = export._replace(
+                    descriptor=parser.ExportGlobal(index),
+                )
+
+
+def _remap_types(module, old_to_new):
+    # Update every reference to a type index, like _remap_functions.
+    if not any(old != new for old, new in old_to_new.items()):
+        return
+
+    type_indexes = _function_type_indexes(module)
+    type_indexes[:] = [old_to_new.get(i, i) for i in type_indexes]
+
+    imports = _imports(module)
+    for position, item in enumerate(imports):
+        descriptor = item.descriptor
+        if isinstance(descriptor, parser.ImportFunc):
+            index = old_to_new.get(descriptor.type, descriptor.type)
+            if index != descriptor.type:
+                imports[position] = item._replace(
+                    descriptor=parser.ImportFunc(index),
+                )
+
+    def remap(instruction):
+        if isinstance(instruction, parser.call_indirect):
+            index = old_to_new.get(instruction.type_index, instruction.type_index)
+            if index != instruction.type_index:
+                return instruction._replace(type_index=index)
+        elif isinstance(instruction, _block_instructions):
+            if isinstance(instruction.type, int):
+                index = old_to_new.get(instruction.type, instruction.type)
+                if index != instruction.type:
+                    return instruction._replace(type=index)
+        return instruction
+
+    _map_code(module, remap)
+
+
+def _rewrite_locals(expression, new_indexes, unread):
+    # Renumber locals, and remove the writes to locals that are never read.
+    result = []
+    for instruction in expression:
+        if isinstance(instruction, _local_instructions):
+            index = instruction.index
+            if index in unread:
+                # A local.tee leaves its value on the stack anyway.
+                if isinstance(instruction, parser.local_set):
+                    result.append(parser.drop())
+                continue
+            new_index = new_indexes.get(index, index)
+            if new_index != index:
+                instruction = instruction._replace(index=new_index)
+        else:
+            updates = {}
+            for field in _nested_fields.get(type(instruction), ()):
+                body = getattr(instruction, field)
+                if body is not None:
+                    updates[field] = _rewrite_locals(body, new_indexes, unread)
+            if updates:
+                instruction = instruction._replace(**updates)
+        result.append(instruction)
+    return result
+
+
+def _to_signed_i32(number):
+    number &= 0xFFFFFFFF
+    return number - (1 << 32) if number >= (1 << 31) else number
+
+
+def _zero_constant(value_type):
+    if value_type in _constants:
+        return _constants[value_type](0)
+    return parser.ref_null(value_type)
+
+
+_active_data_segments = (parser.ActiveDataSegment, parser.ActiveIndexDataSegment)
+
+_block_instructions = (parser.Block, parser.Loop, parser.If)
+
+_constants = {
+    'i32': parser.i32_const,
+    'i64': parser.i64_const,
+    'f32': parser.f32_const,
+    'f64': parser.f64_const,
+}
+
+_local_instructions = (parser.local_get, parser.local_set, parser.local_tee)
+
+_nested_fields = {
+    parser.Block: ('body',),
+    parser.Loop: ('body',),
+    parser.If: ('true_case', 'false_case'),
+}
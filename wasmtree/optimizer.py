@@ -1,46 +1,64 @@
+import functools
+import math
+import struct
+
 from . import parser
 
 
-def run(instructions):
+def eliminate_common_subexpressions(instructions, local_count):
+    # Within each straight-line run of instructions, find pure computations of
+    # constants and locals that are repeated while those locals keep their
+    # values. The first one is saved in a new local with local.tee, and the
+    # others are replaced by local.get. The new locals are numbered from
+    # local_count, and their types are returned along with the instructions.
+    local_types = []
+    result = _eliminate_common_subexpressions(
+        instructions, local_count, local_types,
+    )
+    return result, local_types
+
+
+def expand_divisions(instructions):
+    # Replace signed divisions of a local by a constant with shifts and
+    # multiplications, which are faster but take more space.
+    return run(instructions, _division_rules)
+
+
+def propagate_locals(instructions):
+    # Within each straight-line run of instructions, replace reads of a local
+    # that holds a copy of another local with reads of the original, and turn
+    # writes that are overwritten before they're read into drops (or remove
+    # them, for local.tee). The peephole rules then clean up what's left.
+    return _propagate_locals(instructions, True)
+
+
+def run(instructions, rules=None, assume_no_wrap=False):
     if not instructions or not isinstance(instructions, list):
         return instructions
 
-    result = []
-    for instruction in instructions:
-        # Drop nop instructions.
-        if isinstance(instruction, parser.nop):
-            continue
+    if rules is None:
+        rules = _rules
 
-        # Replace [local.get N, local.set N] with [local.tee N].
-        if (
-            isinstance(instruction, parser.local_get)
-            and result
-            and isinstance(result[-1], parser.local_set)
-            and instruction.index == result[-1].index
-        ):
-            result.pop()
-            result.append(parser.local_tee(instruction.index))
-            continue
+    # Constants added to an address are only folded into the offset of a load
+    # or store when the sum provably fits in 32 bits, since otherwise the
+    # folded access traps where the original one wrapped around. With
+    # assume_no_wrap, they're always folded. That's true for the addresses
+    # that most compilers generate, but not for every program.
+    if assume_no_wrap:
+        rules = {
+            cls: rules.get(cls, []) + _address_rules.get(cls, [])
+            for cls in {**rules, **_address_rules}
+        }
 
-        # Replace [bool-op, eqz] with [reverse-bool-op].
-        if isinstance(instruction, parser.i32_eqz) and result:
-            reverse_op = _reverse_boolean_operator(result[-1])
-            if reverse_op is not None:
-                result.pop()
-                result.append(reverse_op)
-                continue
-
-        # Precompute some constant values.
-        if (
-            _is_binary_operator(instruction)
-            and len(result) >= 2
-            and _is_constant(result[-1])
-            and _is_constant(result[-2])
-        ):
-            const2 = result.pop()
-            const1 = result.pop()
-            result.extend(_precompute(const1, const2, instruction))
-            continue
+    # Each instruction is pushed onto the result, and then checked against the
+    # rules whose pattern ends with that kind of instruction. When a rule
+    # matches the end of the result, the matched instructions are popped and
+    # its replacement is pushed back through the same process. So rules can
+    # match the output of other rules, until nothing else matches.
+    result = []
+    pending = instructions[::-1]
+    while pending:
+        instruction = pending.pop()
 
         # Apply the optimizations to any field that is a list of instructions.
         if isinstance(instruction, parser.Node):
@@ -48,128 +66,863 @@ def run(instructions):
             for field in instruction._fields:
                 value = getattr(instruction, field)
                 if isinstance(value, list):
-                    updates[field] = run(value)
+                    updates[field] = run(value, rules)
             if updates:
                 instruction = instruction._replace(**updates)
 
         result.append(instruction)
+        replacement = _rewrite(result, rules)
+        if replacement is not None:
+            pending.extend(reversed(replacement))
+            continue
+
+        # Drop the rest of the block after an unconditional control transfer,
+        # since it can never run.
+        if isinstance(instruction, _unconditional_transfers):
+            break
     return result
 
 
-def _is_binary_operator(instruction):
-    if not isinstance(instruction, parser.Node):
-        return False
-
-    name = type(instruction).__name__
-    if '_' not in name:
-        return False
-
-    type_name, op_name = name.split('_', 1)
-
-    if type_name not in ['i32', 'i64', 'f32', 'f64']:
-        return False
-
-    types = ['i32', 'i64', 'f32', 'f64']
-    ops = [
-        'add',
-        'and',
-        'copysign',
-        'div',
-        'div_s',
-        'div_u',
-        'eq',
-        'ge',
-        'ge_s',
-        'ge_u',
-        'gt',
-        'gt_s',
-        'gt_u',
-        'le',
-        'le_s',
-        'le_u',
-        'lt',
-        'lt_s',
-        'lt_u',
-        'max',
-        'min',
-        'mul',
-        'ne',
-        'or',
-        'rem_s',
-        'rem_u',
-        'rotl',
-        'rotr',
-        'shl',
-        'shr_s',
-        'shr_u',
-        'sub',
-        'xor',
+def _eliminate_common_subexpressions(instructions, local_count, local_types):
+    # Number the value that each instruction pushes. A value's key is made of
+    # its operator and the keys of its operands, and the key of a local.get
+    # changes whenever the local may have been written. The stack holds the
+    # key of each value (None if unknown) and the positions of the
+    # instructions that compute it.
+    stack = []
+    occurrences = {}
+    versions = {}
+    version = first_version = 0
+
+    def pop(count):
+        operands = stack[max(len(stack) - count, 0):]
+        del stack[len(stack) - len(operands):]
+        return operands if len(operands) == count else None
+
+    for position, instruction in enumerate(instructions):
+        cls = type(instruction)
+        end = position + 1
+
+        if cls in _constant_classes:
+            stack.append(((cls, repr(instruction.number)), position, end))
+
+        elif cls is parser.local_get:
+            index = instruction.index
+            key = ('local', index, versions.get(index, first_version))
+            stack.append((key, position, end))
+
+        elif cls in _folders:
+            operands = pop(len(_folders[cls][0]))
+            key = None
+            start = position
+            if (
+                operands
+                and all(key is not None for key, _, _ in operands)
+                and all(a[2] == b[1] for a, b in zip(operands, operands[1:]))
+                and operands[-1][2] == position
+            ):
+                key = (cls,) + tuple(key for key, _, _ in operands)
+                start = operands[0][1]
+                occurrences.setdefault(key, []).append((start, end))
+            stack.append((key, start, end))
+
+        elif cls in (parser.local_set, parser.local_tee):
+            pop(1)
+            version += 1
+            versions[instruction.index] = version
+            if cls is parser.local_tee:
+                stack.append((None, position, end))
+
+        elif cls is parser.drop:
+            pop(1)
+
+        elif isinstance(instruction, _loads):
+            pop(1)
+            stack.append((None, position, end))
+
+        elif isinstance(instruction, _stores):
+            pop(2)
+
+        else:
+            # Anything else may use any value on the stack. Nested blocks may
+            # also write any local.
+            stack.clear()
+            if cls in _nested_fields:
+                version += 1
+                first_version = version
+                versions.clear()
+
+    # Replace the largest repeated computations first, and skip the ones that
+    # are part of a computation that was already replaced. Each one needs to
+    # save at least two instructions to pay for its local.tee.
+    replacements = {}
+    replaced = [False] * len(instructions)
+    candidates = [key for key, spans in occurrences.items() if len(spans) > 1]
+    candidates.sort(
+        key=lambda key: occurrences[key][0][1] - occurrences[key][0][0],
+        reverse=True,
+    )
+    for key in candidates:
+        spans = [
+            (start, end) for start, end in occurrences[key]
+            if not any(replaced[start:end])
+        ]
+        if len(spans) < 2:
+            continue
+        size = spans[0][1] - spans[0][0]
+        if (len(spans) - 1) * (size - 1) < 2:
+            continue
+
+        index = local_count + len(local_types)
+        local_types.append(_folders[key[0]][1])
+        start, end = spans[0]
+        replacements[start] = (
+            end, instructions[start:end] + [parser.local_tee(index)],
+        )
+        for start, end in spans[1:]:
+            replacements[start] = (end, [parser.local_get(index)])
+        for start, end in spans:
+            replaced[start:end] = [True] * (end - start)
+
+    result = []
+    position = 0
+    while position < len(instructions):
+        if position in replacements:
+            position, replacement = replacements[position]
+            result.extend(replacement)
+            continue
+
+        instruction = instructions[position]
+        if type(instruction) in _nested_fields:
+            updates = {}
+            for field in _nested_fields[type(instruction)]:
+                body = getattr(instruction, field)
+                if body is not None:
+                    updates[field] = _eliminate_common_subexpressions(
+                        body, local_count, local_types,
+                    )
+            instruction = instruction._replace(**updates)
+        result.append(instruction)
+        position += 1
+    return result
+
+
+def _propagate_locals(instructions, is_function_body):
+    result = []
+    copies = {}
+    for instruction in instructions:
+        if type(instruction) in _nested_fields:
+            # Nested blocks may change any local.
+            updates = {}
+            for field in _nested_fields[type(instruction)]:
+                body = getattr(instruction, field)
+                if body is not None:
+                    updates[field] = _propagate_locals(body, False)
+            result.append(instruction._replace(**updates))
+            copies.clear()
+            continue
+
+        if isinstance(instruction, parser.local_get):
+            index = copies.get(instruction.index)
+            if index is not None:
+                instruction = parser.local_get(index)
+
+        elif isinstance(instruction, (parser.local_set, parser.local_tee)):
+            index = instruction.index
+            copies.pop(index, None)
+            for copy in [c for c, original in copies.items() if original == index]:
+                del copies[copy]
+            previous = result[-1] if result else None
+            if isinstance(previous, parser.local_get) and previous.index != index:
+                copies[index] = previous.index
+
+        result.append(instruction)
+
+    # Now go backwards, to find writes that are overwritten before they're
+    # read. Locals are all dead at the end of the function, and after return.
+    all_dead = is_function_body
+    dead = set()
+    read = set()
+    for position in range(len(result) - 1, -1, -1):
+        instruction = result[position]
+        if isinstance(instruction, parser.local_get):
+            dead.discard(instruction.index)
+            read.add(instruction.index)
+
+        elif isinstance(instruction, (parser.local_set, parser.local_tee)):
+            index = instruction.index
+            is_dead = index not in read if all_dead else index in dead
+            if is_dead:
+                if isinstance(instruction, parser.local_set):
+                    result[position] = parser.drop()
+                else:
+                    result[position] = None
+            dead.add(index)
+            read.discard(index)
+
+        elif isinstance(instruction, parser.ret):
+            all_dead = True
+            dead.clear()
+            read.clear()
+
+        elif (
+            isinstance(instruction, _branches)
+            or type(instruction) in _nested_fields
+        ):
+            all_dead = False
+            dead.clear()
+            read.clear()
+
+    return [x for x in result if x is not None]
+
+
+def _rewrite(result, rules):
+    for pattern, function in rules.get(type(result[-1]), ()):
+        count = len(pattern)
+        if count > len(result):
+            continue
+        matched = result[len(result) - count:]
+        if all(isinstance(x, cls) for x, cls in zip(matched, pattern)):
+            replacement = function(*matched)
+            if replacement is not None:
+                del result[len(result) - count:]
+                return replacement
+    return None
+
+
+# Instructions that have no side effects, and push one value.
+_pure_instructions = (
+    parser.f32_const,
+    parser.f64_const,
+    parser.global_get,
+    parser.i32_const,
+    parser.i64_const,
+    parser.local_get,
+)
+
+_loads = (
+    parser.i32_load,
+    parser.i64_load,
+    parser.f32_load,
+    parser.f64_load,
+    parser.i32_load8_s,
+    parser.i32_load8_u,
+    parser.i32_load16_s,
+    parser.i32_load16_u,
+    parser.i64_load8_s,
+    parser.i64_load8_u,
+    parser.i64_load16_s,
+    parser.i64_load16_u,
+    parser.i64_load32_s,
+    parser.i64_load32_u,
+)
+
+_stores = (
+    parser.i32_store,
+    parser.i64_store,
+    parser.f32_store,
+    parser.f64_store,
+    parser.i32_store8,
+    parser.i32_store16,
+    parser.i64_store8,
+    parser.i64_store16,
+    parser.i64_store32,
+)
+
+# Peephole rules, by the class of the last instruction in their pattern. Each
+# rule is a pattern (a sequence of instruction classes, or tuples of classes)
+# and a function that gets the matched instructions. The function returns
+# the replacement instructions, or None to leave them alone. Replacements
+# must be simpler than what they replace, so that rewriting always ends.
+_rules = {}
+
+# The rules that run adds with assume_no_wrap.
+_address_rules = {}
+
+# The rules for expand_divisions. Their replacements are longer than what they
+# replace, which is why they're kept apart from the peephole rules, but they
+# never contain a signed division, so rewriting still ends.
+_division_rules = {}
+
+
+def _add_rule(pattern, function, rules=_rules):
+    last = pattern[-1] if isinstance(pattern[-1], tuple) else (pattern[-1],)
+    for cls in last:
+        rules.setdefault(cls, []).append((pattern, function))
+
+
+def _rule(*pattern, rules=_rules):
+    def decorator(function):
+        _add_rule(pattern, function, rules)
+        return function
+    return decorator
+
+
+@_rule(parser.nop)
+def _drop_nop(nop):
+    return []
+
+
+@_rule(parser.local_set, parser.local_get)
+def _local_tee(local_set, local_get):
+    # Replace [local.set N, local.get N] with [local.tee N].
+    if local_set.index == local_get.index:
+        return [parser.local_tee(local_set.index)]
+
+
+@_rule(parser.local_tee, parser.drop)
+def _local_tee_drop(local_tee, drop):
+    return [parser.local_set(local_tee.index)]
+
+
+@_rule(parser.local_tee, parser.local_set)
+def _local_tee_set(local_tee, local_set):
+    if local_tee.index == local_set.index:
+        return [local_set]
+
+
+@_rule(parser.local_get, parser.local_set)
+def _local_get_set(local_get, local_set):
+    # Setting a local to its own value does nothing.
+    if local_get.index == local_set.index:
+        return []
+
+
+@_rule(_pure_instructions, parser.drop)
+def _pure_drop(instruction, drop):
+    return []
+
+
+@_rule((parser.i32_eq, parser.i32_ne, parser.i64_eq, parser.i64_ne), parser.i32_eqz)
+def _reverse_comparison(comparison, eqz):
+    # Replace [bool-op, eqz] with [reverse-bool-op].
+    return [_reverse_comparisons[type(comparison)]()]
+
+
+@_rule((parser.Block, parser.Loop, parser.If))
+def _drop_empty_block(block):
+    # Drop blocks that don't do anything. An `if` with nothing in either case
+    # still has to pop its condition.
+    if block.type != 'empty':
+        return None
+    if isinstance(block, parser.If):
+        if not block.true_case and not block.false_case:
+            return [parser.drop()]
+    elif not block.body:
+        return []
+
+
+@_rule(_pure_instructions, _pure_instructions, _pure_instructions, parser.select)
+def _select_same_values(first, second, condition, select):
+    # Both values are the same, and nothing here has side effects, so the
+    # condition doesn't matter.
+    if first == second:
+        return [first]
+
+
+@_rule(parser.i32_eqz, parser.i32_eqz, (parser.br_if, parser.If))
+def _drop_double_eqz(first, second, branch):
+    # Branches only check whether the condition is zero.
+    return [branch]
+
+
+@_rule(parser.i32_const, parser.i32_and, parser.i32_const, parser.i32_add, _loads)
+def _fold_masked_load_address(mask, i32_and, constant, i32_add, load):
+    # The address is masked before the constant is added, so the addition
+    # can't wrap around if the mask is small enough.
+    offset = _address_offset(load, constant, maximum=mask.number)
+    if offset is not None:
+        return [mask, i32_and, load._replace(offset=offset)]
+
+
+@_rule(
+    parser.i32_const, parser.i32_and, parser.i32_const, parser.i32_add,
+    _pure_instructions, _stores,
+)
+def _fold_masked_store_address(mask, i32_and, constant, i32_add, value, store):
+    offset = _address_offset(store, constant, maximum=mask.number)
+    if offset is not None:
+        return [mask, i32_and, value, store._replace(offset=offset)]
+
+
+@_rule(parser.i32_const, parser.i32_add, _loads, rules=_address_rules)
+def _fold_load_address(constant, i32_add, load):
+    offset = _address_offset(load, constant)
+    if offset is not None:
+        return [load._replace(offset=offset)]
+
+
+@_rule(
+    parser.i32_const, parser.i32_add, _pure_instructions, _stores,
+    rules=_address_rules,
+)
+def _fold_store_address(constant, i32_add, value, store):
+    offset = _address_offset(store, constant)
+    if offset is not None:
+        return [value, store._replace(offset=offset)]
+
+
+def _address_offset(instruction, constant, maximum=None):
+    # The new offset, after adding a constant to the address, or None if it's
+    # negative or doesn't fit. With a maximum address, the sum of the address
+    # and the constant must also fit in 32 bits.
+    number = constant.number
+    if number < 0:
+        return None
+    if maximum is not None and (maximum & 0xFFFFFFFF) + number > 0xFFFFFFFF:
+        return None
+    offset = instruction.offset + number
+    return offset if offset <= 0xFFFFFFFF else None
+
+
+def _fold(operand_types, result_type, function, *instructions):
+    # Replace an operator whose operands are all constants with its result.
+    # Operators that would trap, and operators whose result is a NaN (since
+    # the exact NaN bits are not preserved), are left alone.
+    operands = [
+        _normalize(t, constant.number)
+        for t, constant in zip(operand_types, instructions)
     ]
-    return type_name in types and op_name in ops
-
-
-def _is_constant(instruction):
-    return isinstance(instruction, (
-        parser.f32_const,
-        parser.f64_const,
-        parser.i32_const,
-        parser.i64_const,
-    ))
-
-
-def _precompute(const1, const2, instruction):
-    t1 = type(const1).__name__.split('_', 1)[0]
-    t2 = type(const2).__name__.split('_', 1)[0]
-    t3, op_name = type(instruction).__name__.split('_', 1)
-
-    # If the types aren't all the same, then who knows what's going on here.
-    # Just leave the sequence alone.
-    if t1 != t2 or t2 != t3:
-        return [const1, const2, instruction]
-
-    result = None
-
-    # Just handle a few operators for now.
-    if op_name == 'add':
-        result = const1.number + const2.number
-    elif op_name == 'eq':
-        result = const1.number == const2.number
-    elif op_name == 'mul':
-        result = const1.number * const2.number
-    elif op_name == 'ne':
-        result = const1.number != const2.number
-    elif op_name == 'sub':
-        result = const1.number - const2.number
-
-    if isinstance(result, bool):
-        return [parser.i32_const(number=int(result))]
-
-    # If the result overflows, then just leave the sequence alone for now.
-    if result is not None and _within_bounds(t1, result):
-        return [const1._replace(number=result)]
-
-    # This operation must not be implemented yet. Just leave the sequence alone.
-    return [const1, const2, instruction]
-
-
-def _within_bounds(type_name, number):
-    if type_name == 'f32' and type_name == 'f64':
-        return True
-    # For now, be pretty conservative about the values that we'll precompute.
-    if type_name == 'i32':
-        return 0 <= number <= (2 ** 30)
-    if type_name == 'i64':
-        return 0 <= number <= (2 ** 60)
-    return False
-
-
-def _reverse_boolean_operator(instruction):
-    # For now, just handle a few integer operations.
-    reverse_ops = {
-        parser.i32_eq: parser.i32_ne,
-        parser.i32_ne: parser.i32_eq,
-        parser.i64_eq: parser.i64_ne,
-        parser.i64_ne: parser.i64_eq,
-    }
-    cls = reverse_ops.get(type(instruction))
-    return None if cls is None else cls()
+
+    try:
+        number = function(*operands)
+    except (ArithmeticError, ValueError):
+        number = None
+
+    if number is None:
+        return None
+
+    if result_type in _integer_bits:
+        number = _normalize(result_type, number)
+    elif math.isnan(number):
+        return None
+    elif result_type == 'f32':
+        number = _round_f32(number)
+
+    return [_constants[result_type](number)]
+
+
+def _float_div(a, b):
+    if b == 0:
+        if a == 0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+    return a / b
+
+
+def _float_max(a, b):
+    if math.isnan(a) or math.isnan(b):
+        return math.nan
+    if a == b:
+        # Positive zero is greater than negative zero.
+        return a if math.copysign(1.0, a) > 0 else b
+    return max(a, b)
+
+
+def _float_min(a, b):
+    if math.isnan(a) or math.isnan(b):
+        return math.nan
+    if a == b:
+        # Negative zero is less than positive zero.
+        return a if math.copysign(1.0, a) < 0 else b
+    return min(a, b)
+
+
+def _float_rounding(function):
+    # Wrap a rounding function (like math.floor) so that it keeps infinities,
+    # NaNs, and the sign of zero results.
+    def result(x):
+        if math.isinf(x) or math.isnan(x) or x == 0:
+            return x
+        return math.copysign(float(function(x)), x)
+    return result
+
+
+def _folders_table():
+    result = {}
+
+    def add(name, operand_types, result_type, function):
+        result[getattr(parser, name)] = (operand_types, result_type, function)
+
+    for t, bits in _integer_bits.items():
+        mask = (1 << bits) - 1
+        min_value = -(1 << (bits - 1))
+
+        def u(n, mask=mask):
+            return n & mask
+
+        binary = {
+            'add': lambda a, b: a + b,
+            'sub': lambda a, b: a - b,
+            'mul': lambda a, b: a * b,
+            'and': lambda a, b: a & b,
+            'or': lambda a, b: a | b,
+            'xor': lambda a, b: a ^ b,
+            'div_s': lambda a, b, min_value=min_value: (
+                None if b == 0 or (a == min_value and b == -1)
+                    else _truncating_div(a, b)
+            ),
+            'div_u': lambda a, b, u=u: None if b == 0 else u(a) // u(b),
+            'rem_s': lambda a, b: (
+                None if b == 0 else a - b * _truncating_div(a, b)
+            ),
+            'rem_u': lambda a, b, u=u: None if b == 0 else u(a) % u(b),
+            'shl': lambda a, b, bits=bits: a << (b % bits),
+            'shr_s': lambda a, b, bits=bits: a >> (b % bits),
+            'shr_u': lambda a, b, u=u, bits=bits: u(a) >> (b % bits),
+            'rotl': lambda a, b, u=u, bits=bits: (
+                u(a) << (b % bits) | u(a) >> (bits - b % bits)
+            ),
+            'rotr': lambda a, b, u=u, bits=bits: (
+                u(a) >> (b % bits) | u(a) << (bits - b % bits)
+            ),
+        }
+        for op, function in binary.items():
+            add(f'{t}_{op}', (t, t), t, function)
+
+        compare = {
+            'eq': lambda a, b: a == b,
+            'ne': lambda a, b: a != b,
+            'lt_s': lambda a, b: a < b,
+            'lt_u': lambda a, b, u=u: u(a) < u(b),
+            'gt_s': lambda a, b: a > b,
+            'gt_u': lambda a, b, u=u: u(a) > u(b),
+            'le_s': lambda a, b: a <= b,
+            'le_u': lambda a, b, u=u: u(a) <= u(b),
+            'ge_s': lambda a, b: a >= b,
+            'ge_u': lambda a, b, u=u: u(a) >= u(b),
+        }
+        for op, function in compare.items():
+            add(f'{t}_{op}', (t, t), 'i32', lambda a, b, f=function: int(f(a, b)))
+
+        add(f'{t}_eqz', (t,), 'i32', lambda a: int(a == 0))
+        add(f'{t}_clz', (t,), t, lambda a, u=u, bits=bits: bits - u(a).bit_length())
+        add(f'{t}_ctz', (t,), t, lambda a, u=u, bits=bits: (
+            bits if a == 0 else (u(a) & -u(a)).bit_length() - 1
+        ))
+        add(f'{t}_popcnt', (t,), t, lambda a, u=u: bin(u(a)).count('1'))
+
+        for width in (8, 16, 32):
+            if width < bits:
+                sign = 1 << (width - 1)
+                add(
+                    f'{t}_extend{width}_s', (t,), t,
+                    lambda a, w=width, s=sign: ((a & ((1 << w) - 1)) ^ s) - s,
+                )
+
+    for t in _float_types:
+        binary = {
+            'add': lambda a, b: a + b,
+            'sub': lambda a, b: a - b,
+            'mul': lambda a, b: a * b,
+            'div': _float_div,
+            'min': _float_min,
+            'max': _float_max,
+            'copysign': math.copysign,
+        }
+        for op, function in binary.items():
+            add(f'{t}_{op}', (t, t), t, function)
+
+        compare = {
+            'eq': lambda a, b: a == b,
+            'ne': lambda a, b: a != b,
+            'lt': lambda a, b: a < b,
+            'gt': lambda a, b: a > b,
+            'le': lambda a, b: a <= b,
+            'ge': lambda a, b: a >= b,
+        }
+        for op, function in compare.items():
+            add(f'{t}_{op}', (t, t), 'i32', lambda a, b, f=function: int(f(a, b)))
+
+        unary = {
+            'abs': abs,
+            'neg': lambda a: -a,
+            'ceil': _float_rounding(math.ceil),
+            'floor': _float_rounding(math.floor),
+            'trunc': _float_rounding(math.trunc),
+            'nearest': _float_rounding(round),
+            'sqrt': math.sqrt,
+        }
+        for op, function in unary.items():
+            add(f'{t}_{op}', (t,), t, function)
+
+    # Conversions.
+    for i in _integer_bits:
+        for f in _float_types:
+            for sign in ('s', 'u'):
+                signed = sign == 's'
+                add(
+                    f'{i}_trunc_{f}_{sign}', (f,), i,
+                    lambda a, i=i, s=signed: _truncate(a, i, s, saturate=False),
+                )
+                add(
+                    f'{i}_trunc_sat_{f}_{sign}', (f,), i,
+                    lambda a, i=i, s=signed: _truncate(a, i, s, saturate=True),
+                )
+
+                mask = (1 << _integer_bits[i]) - 1
+                convert = _int_to_f32 if f == 'f32' else float
+                add(
+                    f'{f}_convert_{i}_{sign}', (i,), f,
+                    lambda a, c=convert, m=mask, s=signed: c(a if s else a & m),
+                )
+
+    add('i32_wrap_i64', ('i64',), 'i32', lambda a: a)
+    add('i64_extend_i32_s', ('i32',), 'i64', lambda a: a)
+    add('i64_extend_i32_u', ('i32',), 'i64', lambda a: a & 0xFFFFFFFF)
+    add('f32_demote_f64', ('f64',), 'f32', _round_f32)
+    add('f64_promote_f32', ('f32',), 'f64', lambda a: a)
+
+    for i, f, int_format, float_format in [
+        ('i32', 'f32', '<i', '<f'),
+        ('i64', 'f64', '<q', '<d'),
+    ]:
+        add(f'{i}_reinterpret_{f}', (f,), i, lambda a, i=int_format, f=float_format: (
+            None if math.isnan(a)
+                else struct.unpack(i, struct.pack(f, a))[0]
+        ))
+        add(f'{f}_reinterpret_{i}', (i,), f, lambda a, i=int_format, f=float_format: (
+            struct.unpack(f, struct.pack(i, a))[0]
+        ))
+
+    return result
+
+
+def _int_to_f32(number):
+    # Round an integer to the nearest f32 (ties to even) in a single step.
+    # Going through a float first would round twice.
+    magnitude = abs(number)
+    shift = magnitude.bit_length() - 24
+    if shift > 0:
+        quotient, remainder = divmod(magnitude, 1 << shift)
+        half = 1 << (shift - 1)
+        if remainder > half or (remainder == half and quotient & 1):
+            quotient += 1
+        magnitude = quotient << shift
+    return -float(magnitude) if number < 0 else float(magnitude)
+
+
+def _normalize(type_name, number):
+    # Integers are stored as signed values, and f32 values are rounded to f32.
+    bits = _integer_bits.get(type_name)
+    if bits is not None:
+        number &= (1 << bits) - 1
+        return number - (1 << bits) if number >> (bits - 1) else number
+    number = float(number)
+    return _round_f32(number) if type_name == 'f32' else number
+
+
+def _power_of_two(number, bits):
+    # The exponent, if the number (as an unsigned integer) is a power of two.
+    number &= (1 << bits) - 1
+    if number and not number & (number - 1):
+        return number.bit_length() - 1
+    return None
+
+
+def _round_f32(number):
+    try:
+        return struct.unpack('<f', struct.pack('<f', number))[0]
+    except OverflowError:
+        return math.copysign(math.inf, number)
+
+
+def _truncate(number, type_name, signed, saturate):
+    bits = _integer_bits[type_name]
+    if signed:
+        low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    else:
+        low, high = 0, (1 << bits) - 1
+
+    if math.isnan(number):
+        return 0 if saturate else None
+    if math.isinf(number):
+        return (high if number > 0 else low) if saturate else None
+
+    result = math.trunc(number)
+    if low <= result <= high:
+        return result
+    if not saturate:
+        return None
+    return high if result > high else low
+
+
+def _truncating_div(a, b):
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+_constants = {
+    'i32': parser.i32_const,
+    'i64': parser.i64_const,
+    'f32': parser.f32_const,
+    'f64': parser.f64_const,
+}
+
+_constant_classes = tuple(_constants.values())
+
+_float_types = ('f32', 'f64')
+
+_integer_bits = {'i32': 32, 'i64': 64}
+
+_reverse_comparisons = {
+    parser.i32_eq: parser.i32_ne,
+    parser.i32_ne: parser.i32_eq,
+    parser.i64_eq: parser.i64_ne,
+    parser.i64_ne: parser.i64_eq,
+}
+
+_branches = (parser.br, parser.br_if, parser.br_table)
+
+_nested_fields = {
+    parser.Block: ('body',),
+    parser.Loop: ('body',),
+    parser.If: ('true_case', 'false_case'),
+}
+
+_unconditional_transfers = (
+    parser.br,
+    parser.br_table,
+    parser.ret,
+    parser.unreachable,
+)
+
+_folders = _folders_table()
+
+
+def _add_folding_rules():
+    for cls, entry in _folders.items():
+        pattern = tuple(_constants[t] for t in entry[0]) + (cls,)
+        _add_rule(pattern, functools.partial(_fold, *entry))
+
+
+_add_folding_rules()
+
+
+def _add_strength_reduction_rules():
+    # Replace multiplication, unsigned division and unsigned remainder by a
+    # power of two with shifts and masks.
+    for t, bits in _integer_bits.items():
+        const = _constants[t]
+        ops = {
+            name: getattr(parser, f'{t}_{name}')
+            for name in ['and', 'div_u', 'mul', 'rem_u', 'shl', 'shr_u']
+        }
+
+        def mul(constant, instruction, const=const, ops=ops, bits=bits):
+            k = _power_of_two(constant.number, bits)
+            if k is not None and k > 0:
+                return [const(k), ops['shl']()]
+
+        def div_u(constant, instruction, const=const, ops=ops, bits=bits):
+            k = _power_of_two(constant.number, bits)
+            if k is not None and k > 0:
+                return [const(k), ops['shr_u']()]
+
+        def rem_u(constant, instruction, const=const, ops=ops, bits=bits):
+            k = _power_of_two(constant.number, bits)
+            if k is not None:
+                return [const(_normalize(t, (1 << k) - 1)), ops['and']()]
+
+        _add_rule((const, ops['mul']), mul)
+        _add_rule((const, ops['div_u']), div_u)
+        _add_rule((const, ops['rem_u']), rem_u)
+
+
+_add_strength_reduction_rules()
+
+
+def _add_division_rules():
+    # Replace signed division by a constant with shifts (and for i32, a 64-bit
+    # multiplication). The dividend is needed twice, so it must be a local.
+    for t, bits in _integer_bits.items():
+        const = _constants[t]
+        ops = {
+            name: getattr(parser, f'{t}_{name}')
+            for name in ['add', 'div_s', 'shr_s', 'shr_u', 'sub']
+        }
+
+        def div_s(local_get, constant, instruction, t=t, const=const, ops=ops,
+                bits=bits):
+            divisor = _normalize(t, constant.number)
+            magnitude = abs(divisor)
+            if magnitude < 2 or magnitude >= 1 << (bits - 1):
+                return None
+
+            k = _power_of_two(magnitude, bits)
+            if k is not None:
+                # Round towards zero by adding (2**k - 1) to negative numbers
+                # before shifting.
+                result = [
+                    local_get,
+                    local_get,
+                    const(bits - 1),
+                    ops['shr_s'](),
+                    const(bits - k),
+                    ops['shr_u'](),
+                    ops['add'](),
+                    const(k),
+                    ops['shr_s'](),
+                ]
+            elif t == 'i32':
+                # Multiply by a rounded-up 2**shift / divisor (in 64 bits),
+                # shift, and add 1 for negative numbers.
+                shift = 32 + magnitude.bit_length() - 1
+                multiplier = -(-(1 << shift) // magnitude)
+                result = [
+                    local_get,
+                    parser.i64_extend_i32_s(),
+                    parser.i64_const(multiplier),
+                    parser.i64_mul(),
+                    parser.i64_const(shift),
+                    parser.i64_shr_s(),
+                    parser.i32_wrap_i64(),
+                    local_get,
+                    const(31),
+                    ops['shr_u'](),
+                    ops['add'](),
+                ]
+            else:
+                # Without a 128-bit multiplication, this wouldn't be faster.
+                return None
+
+            if divisor < 0:
+                result = [const(0)] + result + [ops['sub']()]
+            return result
+
+        _add_rule(
+            (parser.local_get, const, ops['div_s']), div_s, rules=_division_rules,
+        )
+
+
+_add_division_rules()
+
+
+def _add_identity_rules():
+    # Drop integer operations that always return their first operand, like
+    # x + 0 and x * 1. (These aren't identities for floats, because of
+    # negative zero and NaNs.)
+    for t, bits in _integer_bits.items():
+        identities = {
+            'add': lambda c: c == 0,
+            'sub': lambda c: c == 0,
+            'mul': lambda c: c == 1,
+            'div_s': lambda c: c == 1,
+            'div_u': lambda c: c == 1,
+            'and': lambda c: c == -1,
+            'or': lambda c: c == 0,
+            'xor': lambda c: c == 0,
+            'shl': lambda c, bits=bits: c % bits == 0,
+            'shr_s': lambda c, bits=bits: c % bits == 0,
+            'shr_u': lambda c, bits=bits: c % bits == 0,
+            'rotl': lambda c, bits=bits: c % bits == 0,
+            'rotr': lambda c, bits=bits: c % bits == 0,
+        }
+        for op, is_identity in identities.items():
+            def rule(constant, instruction, t=t, is_identity=is_identity):
+                if is_identity(_normalize(t, constant.number)):
+                    return []
+            _add_rule((_constants[t], getattr(parser, f'{t}_{op}')), rule)
+
+
+_add_identity_rules()
@@ -0,0 +1,249 @@
+import functools
+import time
+
+from . import buffer, module_optimizer, optimizer, reader
+
+
+# A pass is either the name of one of the passes below, or a function that
+# updates a parser.Module in place.
+presets = {
+    'O1': ['peephole'],
+    'O2': [
+        'inline_functions',
+        'propagate_constant_globals',
+        'propagate_locals',
+        'peephole',
+        'expand_divisions',
+        'eliminate_common_subexpressions',
+        'coalesce_locals',
+        'remove_unused',
+        'fold_identical_functions',
+    ],
+    'Os': [
+        'propagate_constant_globals',
+        'propagate_locals',
+        'peephole',
+        'coalesce_locals',
+        'remove_unused',
+        'fold_identical_functions',
+        'compact_data_segments',
+    ],
+}
+
+
+class PassStatistics:
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.seconds = 0.0
+        self.instructions_removed = 0
+        self.bytes_saved = 0
+
+    def __repr__(self):
+        return (
+            f'PassStatistics(name={self.name!r}, runs={self.runs},'
+            f' seconds={self.seconds:.6f},'
+            f' instructions_removed={self.instructions_removed},'
+            f' bytes_saved={self.bytes_saved})'
+        )
+
+
+class Report:
+    def __init__(self):
+        self.iterations = 0
+        self.passes = {}
+
+    def __str__(self):
+        width = max([len('pass')] + [len(name) for name in self.passes])
+        lines = [
+            f'{"pass":<{width}} {"runs":>5} {"seconds":>10} {"instrs":>8}'
+            f' {"bytes":>8}'
+        ]
+        for stats in self.passes.values():
+            lines.append(
+                f'{stats.name:<{width}} {stats.runs:>5} {stats.seconds:>10.4f}'
+                f' {stats.instructions_removed:>8} {stats.bytes_saved:>8}'
+            )
+        lines.append(f'{self.iterations} iteration(s)')
+        return '\n'.join(lines)
+
+    @property
+    def bytes_saved(self):
+        return sum(s.bytes_saved for s in self.passes.values())
+
+    @property
+    def instructions_removed(self):
+        return sum(s.instructions_removed for s in self.passes.values())
+
+
+def run(module, passes='O2', max_iterations=8, executor=None,
+        assume_no_wrap=False):
+    # Run the passes in order, and then run them all again until none of them
+    # changes the module's size (or after max_iterations rounds). Returns a
+    # Report with the time that each pass took and what it saved.
+    #
+    # Function-level passes (like 'peephole') can run on an executor, like a
+    # concurrent.futures.ProcessPoolExecutor. The function bodies are sent to
+    # it encoded, in order, and the results are put back in the same order.
+    #
+    # With assume_no_wrap, 'peephole' folds every constant that is added to an
+    # address into the offset of the load or store (see optimizer.run).
+    if isinstance(passes, str):
+        if passes not in presets:
+            raise ValueError(
+                f'Expected one of {list(presets)!r}. Received: {passes!r}.'
+            )
+        passes = presets[passes]
+
+    functions = []
+    for p in passes:
+        name = _pass_name(p)
+        function = _pass_function(p)
+        is_function_pass = _function_passes.get(name) is function
+        if function is optimizer.run and assume_no_wrap:
+            function = functools.partial(optimizer.run, assume_no_wrap=True)
+        functions.append((name, function, is_function_pass))
+
+    report = Report()
+    for name, _, _ in functions:
+        report.passes.setdefault(name, PassStatistics(name))
+
+    # The instruction count is only computed when a module-level pass needs
+    # it, since counting decodes every function body.
+    size = _module_size(module)
+    instructions = None
+    for _ in range(max_iterations):
+        report.iterations += 1
+        changed = False
+        for name, function, is_function_pass in functions:
+            if is_function_pass:
+                start = time.perf_counter()
+                removed = _run_function_pass(module, function, executor)
+                seconds = time.perf_counter() - start
+                if instructions is not None:
+                    instructions -= removed
+            else:
+                if instructions is None:
+                    instructions = _instruction_count(module)
+                start = time.perf_counter()
+                function(module)
+                seconds = time.perf_counter() - start
+                new_instructions = _instruction_count(module)
+                removed = instructions - new_instructions
+                instructions = new_instructions
+
+            new_size = _module_size(module)
+            stats = report.passes[name]
+            stats.runs += 1
+            stats.seconds += seconds
+            stats.bytes_saved += size - new_size
+            stats.instructions_removed += removed
+            if new_size != size or removed:
+                changed = True
+            size = new_size
+
+        if not changed:
+            break
+
+    return report
+
+
+def _code_entries(module):
+    section = module.code_section
+    return section.entries if section is not None else []
+
+
+def _expression_size(expression):
+    return sum(1 for _ in module_optimizer.iter_instructions(expression))
+
+
+def _instruction_count(module):
+    return sum(_expression_size(e.expression) for e in _code_entries(module))
+
+
+def _module_size(module):
+    return len(buffer.Buffer().write_module(module).getvalue())
+
+
+def _pass_function(p):
+    if callable(p):
+        return p
+    if p not in _passes:
+        raise ValueError(f'Expected one of {list(_passes)!r}. Received: {p!r}.')
+    return _passes[p]
+
+
+def _pass_name(p):
+    return p if isinstance(p, str) else getattr(p, '__name__', repr(p))
+
+
+def _run_encoded_entries(function, encoded_entries):
+    # Run a function-level pass on encoded code entries, and return the new
+    # encoded entries, along with the number of instructions that it removed
+    # from each one.
+    results = []
+    for data in encoded_entries:
+        entry = reader.read_code_entry(data)
+        expression = function(entry.expression)
+        removed = _expression_size(entry.expression) - _expression_size(expression)
+        entry = entry._replace(expression=expression)
+        results.append((buffer.Buffer().write_code_entry(entry).getvalue(), removed))
+    return results
+
+
+def _run_function_pass(module, function, executor):
+    # Returns the number of instructions that the pass removed.
+    entries = _code_entries(module)
+    removed = 0
+
+    if executor is None:
+        for position, entry in enumerate(entries):
+            expression = function(entry.expression)
+            if expression != entry.expression:
+                removed += (
+                    _expression_size(entry.expression) - _expression_size(expression)
+                )
+                entries[position] = entry._replace(expression=expression)
+        return removed
+
+    encoded = [buffer.Buffer().write_code_entry(e).getvalue() for e in entries]
+    chunks = [
+        encoded[i:i + _chunk_size] for i in range(0, len(encoded), _chunk_size)
+    ]
+    results = executor.map(
+        functools.partial(_run_encoded_entries, function),
+        chunks,
+    )
+
+    position = 0
+    for chunk in results:
+        for data, entry_removed in chunk:
+            if data != encoded[position]:
+                entries[position] = reader.LazyCodeEntry(memoryview(data))
+                removed += entry_removed
+            position += 1
+    return removed
+
+
+# Function bodies are sent to executors in chunks of this many entries.
+_chunk_size = 256
+
+# Passes that work on one function's expression at a time.
+_function_passes = {
+    'expand_divisions': optimizer.expand_divisions,
+    'peephole': optimizer.run,
+    'propagate_locals': optimizer.propagate_locals,
+}
+
+_passes = {
+    'coalesce_locals': module_optimizer.coalesce_locals,
+    'compact_data_segments': module_optimizer.compact_data_segments,
+    'eliminate_common_subexpressions': (
+        module_optimizer.eliminate_common_subexpressions
+    ),
+    'fold_identical_functions': module_optimizer.fold_identical_functions,
+    'inline_functions': module_optimizer.inline_functions,
+    'propagate_constant_globals': module_optimizer.propagate_constant_globals,
+    'remove_unused': module_optimizer.remove_unused,
+    **_function_passes,
+}
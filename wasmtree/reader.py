@@ -0,0 +1,260 @@
+from . import parser
+
+
+class LazyCodeEntry(parser.CodeEntry):
+    # A code entry that is only decoded when something uses its locals or its
+    # expression. Until then, the Buffer writes its original encoding (which
+    # starts with the entry's size). Once decoded, the entry may be edited, so
+    # the original encoding is dropped.
+    def __init__(self, encoded):
+        parser.Node.__init__(self)
+        self.encoded = encoded
+        self._decoded = None
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, parser.CodeEntry):
+            return False
+        if (
+            isinstance(other, LazyCodeEntry)
+            and self.encoded is not None
+            and other.encoded is not None
+        ):
+            return bytes(self.encoded) == bytes(other.encoded)
+        return self.locals == other.locals and self.expression == other.expression
+
+    __hash__ = parser.Node.__hash__
+
+    def __repr__(self):
+        if self._decoded is None:
+            return f'LazyCodeEntry(<{len(self.encoded)} bytes>)'
+        return repr(self._decoded)
+
+    @property
+    def expression(self):
+        return self._decode().expression
+
+    @expression.setter
+    def expression(self, value):
+        self._decode().expression = value
+
+    @property
+    def is_decoded(self):
+        return self._decoded is not None
+
+    @property
+    def locals(self):
+        return self._decode().locals
+
+    @locals.setter
+    def locals(self, value):
+        self._decode().locals = value
+
+    def _decode(self):
+        if self._decoded is None:
+            self._decoded = read_code_entry(self.encoded)
+            self.encoded = None
+        return self._decoded
+
+    def _replace(self, **kw):
+        for field in self._fields:
+            if field not in kw:
+                kw[field] = getattr(self, field)
+        return parser.CodeEntry(**kw)
+
+
+def read_code_entry(data):
+    # Decode a code entry (starting with its size). The locals are decoded
+    # here, because parser.CodeEntry.parse always tries to read one run of
+    # locals, even when there are none. So a body that starts with bytes like
+    # 41 7F (i32.const -1) would be read as 65 i32 locals.
+    data = memoryview(data)
+    size, pos = _read_u32(data, 0)
+    end = pos + size
+
+    count, pos = _read_u32(data, pos)
+    locals = []
+    for _ in range(count):
+        local_count, pos = _read_u32(data, pos)
+        local_type = parser.ValueType.parse(bytes(data[pos:pos + 1]))
+        locals.append(parser.Locals(local_count, local_type))
+        pos += 1
+
+    expression = parser.Expression.parse(bytes(data[pos:end]))
+    return parser.CodeEntry(locals, expression)
+
+
+def read_module(data):
+    # Read a module from any bytes-like object. Unlike parser.Module.parse,
+    # this leaves function bodies undecoded (as LazyCodeEntry objects) and
+    # keeps data segment contents as memoryviews of the original data, so
+    # reading a large module only decodes the small sections.
+    data = memoryview(data)
+    if data.format != 'B' or data.ndim != 1:
+        data = data.cast('B')
+
+    header = parser.Module.magic + parser.Module.version
+    if bytes(data[:len(header)]) != header:
+        raise ValueError('Expected a Wasm binary module.')
+
+    sections = {}
+    custom_sections = {slot: [] for slot in range(1, 14)}
+    slot = 1
+    pos = len(header)
+
+    while pos < len(data):
+        section_id = data[pos]
+        size, start = _read_u32(data, pos + 1)
+        end = start + size
+
+        if section_id == parser.CustomSection.id:
+            section = parser.CustomSection.parse(bytes(data[pos:end]))
+            custom_sections[slot].append(section)
+
+        elif section_id == parser.CodeSection.id:
+            sections[section_id] = parser.CodeSection(
+                _read_code_entries(data, start, end),
+            )
+
+        elif section_id == parser.DataSection.id:
+            sections[section_id] = parser.DataSection(
+                _read_data_segments(data, start, end),
+            )
+
+        elif section_id in _section_classes:
+            section_class = _section_classes[section_id]
+            sections[section_id] = section_class.parse(bytes(data[pos:end]))
+
+        else:
+            raise ValueError(f'Unknown section id: {section_id:#x}.')
+
+        if section_id != parser.CustomSection.id:
+            slot = _custom_slots[section_id]
+        pos = end
+
+    return parser.Module(
+        type_section=sections.get(parser.TypeSection.id),
+        import_section=sections.get(parser.ImportSection.id),
+        function_section=sections.get(parser.FunctionSection.id),
+        table_section=sections.get(parser.TableSection.id),
+        memory_section=sections.get(parser.MemorySection.id),
+        global_section=sections.get(parser.GlobalSection.id),
+        export_section=sections.get(parser.ExportSection.id),
+        start_section=sections.get(parser.StartSection.id),
+        element_section=sections.get(parser.ElementSection.id),
+        data_count_section=sections.get(parser.DataCountSection.id),
+        code_section=sections.get(parser.CodeSection.id),
+        data_section=sections.get(parser.DataSection.id),
+        **{f'custom{slot}': custom_sections[slot] for slot in custom_sections},
+    )
+
+
+def _read_code_entries(data, pos, end):
+    count, pos = _read_u32(data, pos)
+    entries = []
+    for _ in range(count):
+        size, body = _read_u32(data, pos)
+        entries.append(LazyCodeEntry(data[pos:body + size]))
+        pos = body + size
+    return entries
+
+
+def _read_constant_expression(data, pos):
+    # Find the end of the constant expression, and then parse just that part.
+    start = pos
+    while True:
+        opcode = data[pos]
+        pos += 1
+
+        if opcode == 0x0B:
+            break
+        elif opcode in (0x41, 0x42, 0x23, 0xD2):
+            _, pos = _read_u32(data, pos)
+        elif opcode == 0x43:
+            pos += 4
+        elif opcode == 0x44:
+            pos += 8
+        elif opcode == 0xD0:
+            pos += 1
+        elif opcode not in (0x6A, 0x6B, 0x6C, 0x7C, 0x7D, 0x7E):
+            raise ValueError(
+                f'Unexpected opcode in constant expression: {opcode:#x}.'
+            )
+
+    return parser.Expression.parse(bytes(data[start:pos])), pos
+
+
+def _read_data_segments(data, pos, end):
+    count, pos = _read_u32(data, pos)
+    segments = []
+    for _ in range(count):
+        kind, pos = _read_u32(data, pos)
+
+        if kind == 0x02:
+            index, pos = _read_u32(data, pos)
+
+        if kind in (0x00, 0x02):
+            offset, pos = _read_constant_expression(data, pos)
+
+        size, pos = _read_u32(data, pos)
+        contents = data[pos:pos + size]
+        pos += size
+
+        if kind == 0x00:
+            segments.append(parser.ActiveDataSegment(offset, contents))
+        elif kind == 0x01:
+            segments.append(parser.PassiveDataSegment(contents))
+        elif kind == 0x02:
+            segments.append(parser.ActiveIndexDataSegment(index, offset, contents))
+        else:
+            raise ValueError(f'Unknown data segment kind: {kind:#x}.')
+
+    return segments
+
+
+def _read_u32(data, pos):
+    # Decode a LEB128 integer. (Signed integers are only skipped over, so the
+    # unsigned decoding is good enough for them too.)
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+
+_section_classes = {
+    cls.id: cls
+    for cls in [
+        parser.TypeSection,
+        parser.ImportSection,
+        parser.FunctionSection,
+        parser.TableSection,
+        parser.MemorySection,
+        parser.GlobalSection,
+        parser.ExportSection,
+        parser.StartSection,
+        parser.ElementSection,
+        parser.DataCountSection,
+    ]
+}
+
+# The slot for the custom sections that follow each kind of section.
+_custom_slots = {
+    parser.TypeSection.id: 2,
+    parser.ImportSection.id: 3,
+    parser.FunctionSection.id: 4,
+    parser.TableSection.id: 5,
+    parser.MemorySection.id: 6,
+    parser.GlobalSection.id: 7,
+    parser.ExportSection.id: 8,
+    parser.StartSection.id: 9,
+    parser.ElementSection.id: 10,
+    parser.DataCountSection.id: 11,
+    parser.CodeSection.id: 12,
+    parser.DataSection.id: 13,
+}